@@ -0,0 +1,126 @@
+from web3.providers.base import JSONBaseProvider
+from requests.exceptions import Timeout
+import asyncio
+import threading
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from rpc import encode_batch_request, match_batch_responses
+from scheduler import RequestScheduler
+
+
+class AsyncRPCBackend(object):
+
+    MAX_IN_FLIGHT = 64
+    TIMEOUT = 30
+
+    def __init__(self, pool_size, max_in_flight=MAX_IN_FLIGHT):
+
+        if aiohttp is None:
+            raise ImportError('the async rpc backend needs aiohttp (pip install aiohttp)')
+
+        # one event loop thread serves every node, at most max_in_flight requests per node are on the wire and
+        # every further request waits on that node's semaphore
+        self.pool_size = pool_size
+        self.max_in_flight = max(max_in_flight, 1)
+
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+
+        self._sessions = dict()
+        self._semaphores = dict()
+
+    def submit(self, coroutine):
+        # concurrent.futures.Future of a coroutine running on the backend's loop
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run(self, coroutine):
+        return self.submit(coroutine).result()
+
+    def session(self, node_url):
+
+        # only called from the loop thread
+        if node_url not in self._sessions:
+            connector = aiohttp.TCPConnector(limit=max(self.pool_size, self.max_in_flight))
+            self._sessions[node_url] = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.TIMEOUT))
+            self._semaphores[node_url] = asyncio.Semaphore(self.max_in_flight)
+
+        return self._sessions[node_url], self._semaphores[node_url]
+
+    async def post(self, node_url, request_data):
+
+        session, semaphore = self.session(node_url)
+        async with semaphore:
+            try:
+                async with session.post(node_url, data=request_data, headers={'Content-Type': 'application/json'}) as response:
+                    response.raise_for_status()
+                    return await response.read()
+            except asyncio.TimeoutError as e:
+                # raised like the requests timeouts of the blocking provider, which the scanner treats as a size error
+                raise Timeout('no response from {} after {}s'.format(node_url, self.TIMEOUT)) from e
+
+    async def close_sessions(self):
+
+        for session in self._sessions.values():
+            await session.close()
+
+        self._sessions.clear()
+        self._semaphores.clear()
+
+    def close(self):
+
+        self.run(self.close_sessions())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+class AsyncHTTPProvider(JSONBaseProvider):
+
+    def __init__(self, endpoint_uri, backend, scheduler=None, cassette=None, channel=None):
+
+        # a blocking web3 provider on top of the async backend, so web3 calls, log scans and batch callers run unchanged
+        super().__init__()
+        self.endpoint_uri = endpoint_uri
+        self.backend = backend
+        self.scheduler = scheduler or RequestScheduler()
+        self.cassette = cassette
+        self.channel = channel
+
+    @property
+    def max_pending(self):
+        # batches a caller keeps submitted, a few per in-flight slot so the node is never idle between batches
+        return 4 * self.backend.max_in_flight
+
+    async def send(self, request_data):
+        return self.decode_rpc_response(await self.backend.post(self.endpoint_uri, request_data))
+
+    async def exchange(self, request_data):
+
+        if self.cassette is not None:
+            return await self.cassette.async_call(self.channel, request_data, lambda: self.send(request_data))
+        return await self.send(request_data)
+
+    async def post(self, request_data):
+        return await self.scheduler.async_call(self.endpoint_uri, lambda: self.exchange(request_data))
+
+    async def request(self, method, params):
+        return await self.post(self.encode_rpc_request(method, params))
+
+    async def batch_request(self, calls):
+        rpc_calls, request_data = encode_batch_request(calls, self.request_counter)
+        return match_batch_responses(rpc_calls, await self.post(request_data))
+
+    def make_request(self, method, params):
+        return self.backend.run(self.request(method, params))
+
+    def make_batch_request(self, calls):
+        return self.backend.run(self.batch_request(calls))
+
+    def submit_batch_request(self, calls):
+        # returns a concurrent.futures.Future of the responses
+        return self.backend.submit(self.batch_request(calls))
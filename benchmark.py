@@ -0,0 +1,218 @@
+from multiprocessing import Process, Pipe
+from collections import Counter
+from pathlib import Path
+from datetime import datetime, timezone
+import subprocess
+import tracemalloc
+import tempfile
+import platform
+import argparse
+import json
+import time
+import os
+
+from main import VaultDetection
+from rpc import BatchCaller
+from scanner import BlockRangeScanner
+from mock_node import SyntheticChain, MockNode, DEPOSIT
+
+
+SCALES = [1000, 100000, 1000000]
+LOGS_PER_USER = 2
+CHUNK_SIZE = 100000
+RESULTS_FNAME = 'benchmark_results.json'
+# a phase slower than its baseline by more than this share is reported as a regression
+TOLERANCE = 0.2
+
+
+def serve_chain(conn, n_users, n_logs, master_chef, lp_address, node_kwargs):
+
+    # runs in its own process, so the node's work and memory are not counted in the pipeline's phases. answers
+    # 'stats' with the node's request counters until it gets 'stop'
+    chain = SyntheticChain(n_users, n_logs, n_pools=1, master_chef=master_chef, lp_addresses={0: lp_address})
+    node = MockNode(chain, **node_kwargs)
+    node.start()
+
+    blocks, log_indexes, events, users, amounts = chain.logs[0]
+    conn.send((node.url, chain.start_block, chain.head_block, events.count(DEPOSIT)))
+
+    while conn.recv() == 'stats':
+        conn.send(dict(node.stats))
+
+    node.stop()
+
+
+def git_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Benchmark(object):
+
+    def __init__(self, scale, contract_info, node_kwargs=None, track_memory=True, verbose=0, **kwargs):
+
+        # the pipeline of one config entry against a synthetic chain of scale users with LOGS_PER_USER logs each,
+        # kwargs are passed to VaultDetection (e.g. use_multicall, async_rpc, batch_size)
+        self.scale = scale
+        self.contract_info = contract_info
+        self.node_kwargs = dict({'max_results': None}, **(node_kwargs or dict()))
+        self.track_memory = track_memory
+        self.verbose = verbose
+        self.kwargs = kwargs
+        self.results = list()
+
+        self._conn = None
+
+    def node_stats(self):
+        self._conn.send('stats')
+        return Counter(self._conn.recv())
+
+    def measure(self, phase, run, blocks=None, logs=None, users=None):
+
+        # duration, throughput, json-rpc calls and peak traced memory above the phase's start
+        stats = self.node_stats()
+        if self.track_memory:
+            tracemalloc.reset_peak()
+            memory = tracemalloc.get_traced_memory()[0]
+
+        start = time.perf_counter()
+        result = run()
+        seconds = time.perf_counter() - start
+
+        # the node also counts http_requests, http_429 and http_stalled next to the json-rpc methods
+        stats = self.node_stats() - stats
+        calls = {method: count for method, count in stats.items() if not method.startswith('http_')}
+        row = {'scale': self.scale, 'phase': phase, 'seconds': round(seconds, 4), 'http_requests': stats['http_requests'],
+               'rpc_calls': sum(calls.values()), 'rpc_methods': calls,
+               'peak_memory_mb': round((tracemalloc.get_traced_memory()[1] - memory) / 2 ** 20, 2) if self.track_memory else None}
+
+        for unit, count in (('blocks', blocks), ('logs', logs), ('users', users)):
+            if count is not None:
+                row[unit] = count
+                row['{}_per_s'.format(unit)] = round(count / seconds, 1) if seconds else None
+
+        self.results.append(row)
+        if self.verbose >= 1:
+            print('[{}] {}: {:.2f}s, {} rpc calls'.format(self.scale, phase, seconds, row['rpc_calls']))
+
+        return result
+
+    def run(self):
+
+        conn, self._conn = Pipe()
+        node_process = Process(target=serve_chain, args=(conn, self.scale, LOGS_PER_USER * self.scale, self.contract_info['address'],
+                                                         self.contract_info['lp']['address'], self.node_kwargs), daemon=True)
+        node_process.start()
+
+        try:
+            node_url, start_block, head_block, n_deposit_logs = self._conn.recv()
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                self.run_phases(node_url, start_block, head_block, n_deposit_logs, tmp_dir)
+        finally:
+            self._conn.send('stop')
+            node_process.join()
+
+        return self.results
+
+    def run_phases(self, node_url, start_block, head_block, n_deposit_logs, tmp_dir):
+
+        vault_detection = VaultDetection(self.verbose, node_url, node_url, cache_fname=None, state_fname='{}/state.sqlite'.format(tmp_dir),
+                                         code_fname='{}/code.sqlite'.format(tmp_dir), **self.kwargs)
+        vault_detection.contract_info = dict(self.contract_info, name='benchmark_{}'.format(self.scale), pid=0, start_block=start_block,
+                                             end_block=head_block, n_blocks=head_block - start_block,
+                                             chunk_size=self.contract_info.get('chunk_size') or CHUNK_SIZE)
+        vault_detection.snapshot_block = head_block
+
+        if self.track_memory:
+            tracemalloc.start()
+
+        try:
+            addresses = list(self.measure('scan', vault_detection.find_depositors, blocks=head_block - start_block + 1, logs=n_deposit_logs).keys())
+            amounts = self.measure('enrich', lambda: vault_detection.get_user_amounts(addresses), users=len(addresses))
+
+            holders = [addr for addr, amount in zip(addresses, amounts) if amount > 0]
+            codes = self.measure('is_contract', lambda: vault_detection.get_codes(holders), users=len(holders))
+            self.measure('is_contract_cached', lambda: vault_detection.get_codes(holders), users=len(holders))
+            classes = self.measure('classify', lambda: vault_detection.classify_contracts(codes), users=len(holders))
+
+            master_chef_balance_usd, master_chef_lp = self.measure('pricing', vault_detection.get_master_chef_balance)
+            users_info = self.measure('users_info', lambda: vault_detection.make_users_info(addresses, amounts, master_chef_balance_usd,
+                                                                                           master_chef_lp, codes, classes), users=len(holders))
+            users_info = self.measure('sort', lambda: sorted(users_info, key=lambda x: x[1], reverse=True), users=len(holders))
+
+            self.measure('csv', lambda: self.write_csv(vault_detection, users_info), users=len(holders))
+        finally:
+            if self.track_memory:
+                tracemalloc.stop()
+            vault_detection.clients.close()
+            vault_detection.state_store.close()
+            vault_detection.code_store.close()
+
+    @staticmethod
+    def write_csv(vault_detection, users_info):
+
+        # csv_writer writes to the home directory, the file is removed again
+        vault_detection.csv_writer(VaultDetection.USERS_INFO_COLUMNS, users_info)
+        os.remove('{}/{}.csv'.format(str(Path.home()), vault_detection.contract_info['name']))
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+
+    # (scale, phase, seconds, baseline seconds) of the phases slower than the baseline by more than tolerance
+    baseline_seconds = {(row['scale'], row['phase']): row['seconds'] for row in baseline['results']}
+    return [(row['scale'], row['phase'], row['seconds'], baseline_seconds[(row['scale'], row['phase'])]) for row in results
+            if (row['scale'], row['phase']) in baseline_seconds and row['seconds'] > (1 + tolerance) * baseline_seconds[(row['scale'], row['phase'])]]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--verbose', required=False, help='verbose level', default=0, type=int)
+    parser.add_argument('--scales', required=False, help='comma separated depositor counts, defaults to 1000,100000,1000000',
+                        default=','.join(str(scale) for scale in SCALES))
+    parser.add_argument('--config_entry', required=False, help='name of the config.json entry whose abis are used, defaults to the first one', default=None)
+    parser.add_argument('--out', required=False, help='results file, defaults to {}'.format(RESULTS_FNAME), default=RESULTS_FNAME)
+    parser.add_argument('--baseline', required=False, help='results file of a previous version, slower phases are reported and exit with status 1', default=None)
+    parser.add_argument('--tolerance', required=False, help='share a phase may be slower than the baseline, defaults to {}'.format(TOLERANCE),
+                        default=TOLERANCE, type=float)
+    parser.add_argument('--latency', required=False, help='seconds per http request of the mock node, defaults to 0', default=0.0, type=float)
+    parser.add_argument('--no_memory', required=False, help='do not trace memory, which slows the phases down', action='store_true')
+    parser.add_argument('--use_multicall', required=False, help='reads contract state through Multicall3', action='store_true')
+    parser.add_argument('--async_rpc', required=False, help='uses the aiohttp rpc backend', action='store_true')
+    parser.add_argument('--batch_size', required=False, help='calls per json-rpc batch, defaults to {}'.format(BatchCaller.BATCH_SIZE),
+                        default=BatchCaller.BATCH_SIZE, type=int)
+    parser.add_argument('--n_workers', required=False, help='parallel requests, defaults to {}'.format(BlockRangeScanner.N_WORKERS),
+                        default=BlockRangeScanner.N_WORKERS, type=int)
+    args = parser.parse_args()
+
+    with open(VaultDetection.CONFIG_FNAME) as f:
+        contracts_info = json.load(f)
+    contract_info = [info for info in contracts_info if args.config_entry in (None, info['name'])][0]
+
+    results = list()
+    for scale in [int(scale) for scale in args.scales.split(',')]:
+        results += Benchmark(scale, contract_info, {'latency': args.latency}, track_memory=not args.no_memory, verbose=args.verbose,
+                             use_multicall=args.use_multicall, async_rpc=args.async_rpc, batch_size=args.batch_size, n_workers=args.n_workers).run()
+
+    print('{:>8} {:<20} {:>9} {:>10} {:>10} {:>10} {:>9} {:>8}'.format('scale', 'phase', 'seconds', 'blocks/s', 'logs/s', 'users/s', 'rpc calls', 'peak mb'))
+    for row in results:
+        print('{:>8} {:<20} {:>9.3f} {:>10} {:>10} {:>10} {:>9} {:>8}'.format(row['scale'], row['phase'], row['seconds'], row.get('blocks_per_s', ''),
+                                                                          row.get('logs_per_s', ''), row.get('users_per_s', ''), row['rpc_calls'],
+                                                                          '' if row['peak_memory_mb'] is None else row['peak_memory_mb']))
+
+    with open(args.out, 'w') as f:
+        json.dump({'version': git_version(), 'time': datetime.now(timezone.utc).isoformat(), 'python': platform.python_version(),
+                   'settings': {key: value for key, value in vars(args).items() if key not in ('out', 'baseline', 'verbose')}, 'results': results}, f, indent=2)
+    print('results written to {}'.format(args.out))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+
+        for scale, phase, seconds, baseline_seconds in regressions:
+            print('[{}] {} regressed: {:.3f}s (baseline {:.3f}s)'.format(scale, phase, seconds, baseline_seconds))
+        if regressions:
+            exit(1)
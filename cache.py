@@ -0,0 +1,267 @@
+from pathlib import Path
+import threading
+import sqlite3
+import json
+
+
+class LogCache(object):
+
+    CACHE_FNAME = '{}/.vault_detection/logs.sqlite'.format(str(Path.home()))
+    # bumped whenever the stored entry layout changes, older caches are dropped
+    SCHEMA_VERSION = 2
+
+    def __init__(self, fname=CACHE_FNAME):
+
+        Path(fname).parent.mkdir(parents=True, exist_ok=True)
+
+        self.fname = fname
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(fname, check_same_thread=False)
+
+        with self._db:
+            if self._db.execute('PRAGMA user_version').fetchone()[0] != self.SCHEMA_VERSION:
+                self._db.execute('DROP TABLE IF EXISTS ranges')
+                self._db.execute('DROP TABLE IF EXISTS logs')
+                self._db.execute('PRAGMA user_version = {}'.format(self.SCHEMA_VERSION))
+
+            self._db.execute('CREATE TABLE IF NOT EXISTS ranges (key TEXT, from_block INTEGER, to_block INTEGER)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS logs (key TEXT, block_number INTEGER, log_index INTEGER, args TEXT, '
+                             'PRIMARY KEY (key, block_number, log_index))')
+            self._db.execute('CREATE INDEX IF NOT EXISTS ranges_key ON ranges (key, from_block)')
+
+    @staticmethod
+    def make_key(blockchain, address, topics):
+        # one cache namespace per chain, contract and encoded topic filter (event + indexed arguments such as the pid)
+        return json.dumps([blockchain.lower(), address.lower(), topics])
+
+    def covered_ranges(self, key):
+
+        with self._lock:
+            rows = self._db.execute('SELECT from_block, to_block FROM ranges WHERE key = ? ORDER BY from_block', (key,)).fetchall()
+
+        # merge overlapping and adjacent ranges
+        merged = list()
+        for from_block, to_block in rows:
+            if merged and from_block <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], to_block)
+            else:
+                merged.append([from_block, to_block])
+
+        return [tuple(block_range) for block_range in merged]
+
+    def segments(self, key, first_block, last_block):
+
+        # splits [first_block, last_block] into (from_block, to_block, is_cached) segments, newest first
+        segments = list()
+        cursor = first_block
+
+        for from_block, to_block in self.covered_ranges(key):
+
+            if to_block < cursor or from_block > last_block:
+                continue
+
+            if from_block > cursor:
+                segments.append((cursor, from_block - 1, False))
+
+            segments.append((max(from_block, cursor), min(to_block, last_block), True))
+            cursor = min(to_block, last_block) + 1
+
+        if cursor <= last_block:
+            segments.append((cursor, last_block, False))
+
+        return segments[::-1]
+
+    def get_entries(self, key, from_block, to_block, entry_type):
+
+        # entry_type: the LogScanner's entry tuple, stored as block number, log index and a json list of the event name and arguments
+        with self._lock:
+            rows = self._db.execute('SELECT block_number, log_index, args FROM logs WHERE key = ? AND block_number BETWEEN ? AND ? '
+                                    'ORDER BY block_number, log_index', (key, from_block, to_block)).fetchall()
+
+        return [entry_type(block_number, log_index, *json.loads(args)) for block_number, log_index, args in rows]
+
+    def add(self, key, from_block, to_block, entries):
+
+        if from_block > to_block:
+            return
+
+        rows = [(key, entry.block_number, entry.log_index, json.dumps(entry[2:]))
+                for entry in entries if from_block <= entry.block_number <= to_block]
+
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO logs VALUES (?, ?, ?, ?)', rows)
+            self._db.execute('INSERT INTO ranges VALUES (?, ?, ?)', (key, from_block, to_block))
+
+    def compact(self, key):
+
+        # one row per merged range instead of one per scanned chunk
+        covered_ranges = self.covered_ranges(key)
+
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM ranges WHERE key = ?', (key,))
+            self._db.executemany('INSERT INTO ranges VALUES (?, ?, ?)', [(key, from_block, to_block) for from_block, to_block in covered_ranges])
+
+    def close(self):
+
+        with self._lock:
+            self._db.close()
+
+
+class StateStore(object):
+
+    STATE_FNAME = '{}/.vault_detection/state.sqlite'.format(str(Path.home()))
+    # bumped whenever the checkpoint layout changes, older checkpoints are dropped
+    SCHEMA_VERSION = 1
+
+    def __init__(self, fname=STATE_FNAME):
+
+        Path(fname).parent.mkdir(parents=True, exist_ok=True)
+
+        self.fname = fname
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(fname, check_same_thread=False)
+
+        with self._db:
+            if self._db.execute('PRAGMA user_version').fetchone()[0] != self.SCHEMA_VERSION:
+                self._db.execute('DROP TABLE IF EXISTS checkpoints')
+                self._db.execute('DROP TABLE IF EXISTS checkpoint_depositors')
+                self._db.execute('PRAGMA user_version = {}'.format(self.SCHEMA_VERSION))
+
+            self._db.execute('CREATE TABLE IF NOT EXISTS scans (key TEXT PRIMARY KEY, last_block INTEGER)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS depositors (key TEXT, address TEXT, amount TEXT, PRIMARY KEY (key, address))')
+            self._db.execute('CREATE TABLE IF NOT EXISTS checkpoints (key TEXT PRIMARY KEY, first_block INTEGER, last_block INTEGER, next_block INTEGER, '
+                             'snapshot_block INTEGER)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS checkpoint_depositors (key TEXT, address TEXT, amount TEXT, PRIMARY KEY (key, address))')
+
+    @staticmethod
+    def make_key(contract_info, mode=None):
+        key = [contract_info['name'], contract_info['blockchain'].lower(), contract_info['address'].lower(), contract_info['pid']]
+        return json.dumps(key + [mode] if mode else key)
+
+    def get_scan(self, key):
+
+        # returns (last scanned block, {user: amount}) or (None, {}) if this entry was never scanned
+        with self._lock:
+            row = self._db.execute('SELECT last_block FROM scans WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None, dict()
+
+            rows = self._db.execute('SELECT address, amount FROM depositors WHERE key = ?', (key,)).fetchall()
+
+        return row[0], {address: int(amount) for address, amount in rows}
+
+    def save_scan(self, key, last_block, deposits):
+
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO scans VALUES (?, ?)', (key, last_block))
+            self._db.execute('DELETE FROM depositors WHERE key = ?', (key,))
+            self._db.executemany('INSERT INTO depositors VALUES (?, ?, ?)', [(key, address, str(amount)) for address, amount in deposits.items()])
+
+    def get_checkpoint(self, key):
+
+        # returns (first_block, last_block, next_block, snapshot_block, {user: amount}) of an interrupted scan of
+        # [first_block, last_block], blocks above next_block are done
+        with self._lock:
+            row = self._db.execute('SELECT first_block, last_block, next_block, snapshot_block FROM checkpoints WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+
+            rows = self._db.execute('SELECT address, amount FROM checkpoint_depositors WHERE key = ?', (key,)).fetchall()
+
+        return row[0], row[1], row[2], row[3], {address: int(amount) for address, amount in rows}
+
+    def save_checkpoint(self, key, first_block, last_block, next_block, snapshot_block, deposits):
+
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?)', (key, first_block, last_block, next_block, snapshot_block))
+            self._db.execute('DELETE FROM checkpoint_depositors WHERE key = ?', (key,))
+            self._db.executemany('INSERT INTO checkpoint_depositors VALUES (?, ?, ?)', [(key, address, str(amount)) for address, amount in deposits.items()])
+
+    def clear_checkpoint(self, key):
+
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM checkpoints WHERE key = ?', (key,))
+            self._db.execute('DELETE FROM checkpoint_depositors WHERE key = ?', (key,))
+
+    def close(self):
+
+        with self._lock:
+            self._db.close()
+
+
+class CodeStore(object):
+
+    CODE_FNAME = '{}/.vault_detection/code.sqlite'.format(str(Path.home()))
+    SCHEMA_VERSION = 2
+    # sqlite's default limit of variables per statement is 999
+    QUERY_SIZE = 500
+
+    def __init__(self, fname=CODE_FNAME):
+
+        Path(fname).parent.mkdir(parents=True, exist_ok=True)
+
+        self.fname = fname
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(fname, check_same_thread=False)
+
+        with self._db:
+            if self._db.execute('PRAGMA user_version').fetchone()[0] != self.SCHEMA_VERSION:
+                self._db.execute('DROP TABLE IF EXISTS codes')
+                self._db.execute('DROP TABLE IF EXISTS classifications')
+                self._db.execute('PRAGMA user_version = {}'.format(self.SCHEMA_VERSION))
+
+            # only the hash and size of an account's code are kept, with the block it was read at and the implementation
+            # of minimal proxies
+            self._db.execute('CREATE TABLE IF NOT EXISTS codes (blockchain TEXT, address TEXT, block_number INTEGER, code_hash TEXT, code_size INTEGER, '
+                             'proxy_target TEXT, PRIMARY KEY (blockchain, address))')
+            # proxy pattern and contract type per code hash (or code hash and implementation of upgradeable proxies)
+            self._db.execute('CREATE TABLE IF NOT EXISTS classifications (blockchain TEXT, key TEXT, proxy TEXT, contract_type TEXT, '
+                             'PRIMARY KEY (blockchain, key))')
+
+    def select(self, query, blockchain, keys):
+
+        # runs query (with an IN list) for every QUERY_SIZE keys
+        keys = list(keys)
+        rows = list()
+
+        with self._lock:
+            for i in range(0, len(keys), self.QUERY_SIZE):
+                batch = keys[i:i + self.QUERY_SIZE]
+                rows += self._db.execute(query.format(', '.join('?' * len(batch))), [blockchain.lower()] + batch).fetchall()
+
+        return rows
+
+    def get_codes(self, blockchain, addresses):
+
+        # returns {address: (block_number, code_hash, code_size, proxy_target)} of the known addresses
+        addresses = list(addresses)
+        rows = self.select('SELECT address, block_number, code_hash, code_size, proxy_target FROM codes WHERE blockchain = ? AND address IN ({})',
+                           blockchain, [address.lower() for address in addresses])
+        codes = {row[0]: row[1:] for row in rows}
+
+        return {address: codes[address.lower()] for address in addresses if address.lower() in codes}
+
+    def add(self, blockchain, codes):
+
+        # codes: {address: (block_number, code_hash, code_size, proxy_target)}
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO codes VALUES (?, ?, ?, ?, ?, ?)',
+                                 [(blockchain.lower(), address.lower()) + tuple(code) for address, code in codes.items()])
+
+    def get_classifications(self, blockchain, keys):
+
+        # returns {key: (proxy, contract_type)} of the known keys
+        rows = self.select('SELECT key, proxy, contract_type FROM classifications WHERE blockchain = ? AND key IN ({})', blockchain, keys)
+        return {key: (proxy, contract_type) for key, proxy, contract_type in rows}
+
+    def add_classifications(self, blockchain, classifications):
+
+        # classifications: {key: (proxy, contract_type)}
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO classifications VALUES (?, ?, ?, ?)',
+                                 [(blockchain.lower(), key, proxy, contract_type) for key, (proxy, contract_type) in classifications.items()])
+
+    def close(self):
+
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,170 @@
+from requests.exceptions import Timeout, HTTPError, ConnectionError
+from collections import deque
+import requests
+import threading
+import asyncio
+import gzip
+import json
+import time
+import zlib
+
+from scheduler import classify_error, RATE_LIMITED, TIMEOUT
+
+
+class Cassette(object):
+
+    def __init__(self, fname, replay=False, latency=0.0, verbose=0):
+
+        # records every json-rpc call and its response (or transport error) to a gzipped json lines file, or replays
+        # them without network. calls are matched per channel (the blockchain) on their method and params, ignoring
+        # ids, and identical calls get their responses in recorded order. the calls of a batch are recorded one by one,
+        # so a replayed batch may group them differently. replayed answers take latency times as long as when recorded
+        self.fname = fname
+        self.replay = replay
+        self.latency = latency
+        self.verbose = verbose
+
+        self._lock = threading.Lock()
+        self._tracks = dict()
+        self._file = None
+
+        if replay:
+            self.load()
+        else:
+            self._file = gzip.open(fname, 'wt')
+
+    @staticmethod
+    def make_key(channel, call):
+        # call: [method, params]
+        return json.dumps([channel, call], sort_keys=True)
+
+    @staticmethod
+    def strip_id(rpc_call):
+        return [rpc_call['method'], rpc_call.get('params') or []]
+
+    def load(self):
+
+        with gzip.open(self.fname, 'rt') as f:
+            try:
+                for line in f:
+                    record = json.loads(line)
+                    self._tracks.setdefault(self.make_key(record['channel'], record['call']), deque()).append(record)
+            except (EOFError, zlib.error, ValueError) as e:
+                # a recording whose run was killed ends with a truncated line
+                if self.verbose >= 1:
+                    print('{} is truncated ({!r}), replaying the calls before'.format(self.fname, e))
+
+    def record(self, channel, rpc_request, response=None, error=None, latency=0.0):
+
+        # one record per call. a batch answered with a single error object, or failing as a whole, fails every call's record
+        rpc_calls = rpc_request if isinstance(rpc_request, list) else [rpc_request]
+        if error is not None:
+            outcomes = [{'error': {'class': classify_error(error), 'message': str(error)}}] * len(rpc_calls)
+        elif isinstance(rpc_request, list) and not isinstance(response, list):
+            outcomes = [{'batch_response': response}] * len(rpc_calls)
+        elif isinstance(rpc_request, list):
+            responses = {r.get('id'): r for r in response}
+            outcomes = [{'response': responses.get(rpc_call['id'])} for rpc_call in rpc_calls]
+        else:
+            outcomes = [{'response': response}]
+
+        lines = [json.dumps(dict(outcome, channel=channel, call=self.strip_id(rpc_call), latency=round(latency, 4)))
+                 for rpc_call, outcome in zip(rpc_calls, outcomes)]
+        with self._lock:
+            self._file.write(''.join(line + '\n' for line in lines))
+
+    def next_record(self, channel, rpc_call):
+
+        # the oldest unplayed record of the call, the last one is replayed again for any further identical call
+        key = self.make_key(channel, self.strip_id(rpc_call))
+        with self._lock:
+            track = self._tracks.get(key)
+            if not track:
+                return None
+            return track.popleft() if len(track) > 1 else track[0]
+
+    @staticmethod
+    def raise_error(error):
+
+        # raised like the original error, so the scheduler and the scanner handle it the same way
+        if error['class'] == TIMEOUT:
+            raise Timeout(error['message'])
+        if error['class'] == RATE_LIMITED:
+            response = requests.Response()
+            response.status_code = 429
+            raise HTTPError(error['message'], response=response)
+        raise ConnectionError(error['message'])
+
+    def replayed(self, rpc_request, records):
+
+        for record in records:
+            if 'error' in record:
+                self.raise_error(record['error'])
+        for record in records:
+            if 'batch_response' in record:
+                return record['batch_response']
+
+        responses = [None if record['response'] is None else dict(record['response'], id=rpc_call.get('id'))
+                     for rpc_call, record in zip(rpc_request if isinstance(rpc_request, list) else [rpc_request], records)]
+        if isinstance(rpc_request, list):
+            return [response for response in responses if response is not None]
+        return responses[0]
+
+    def lookup(self, channel, request_data):
+
+        # the records of every call of the request, and how long the slowest of them took
+        rpc_request = json.loads(request_data)
+        records = list()
+        for rpc_call in rpc_request if isinstance(rpc_request, list) else [rpc_request]:
+            record = self.next_record(channel, rpc_call)
+            if record is None:
+                # as if the node was unreachable
+                raise ConnectionError('call not in cassette {}: {}'.format(self.fname, self.strip_id(rpc_call)))
+            records.append(record)
+
+        return rpc_request, records, max((record['latency'] for record in records), default=0)
+
+    def call(self, channel, request_data, send):
+
+        # send() posts request_data and returns the decoded response
+        if self.replay:
+            rpc_request, records, latency = self.lookup(channel, request_data)
+            if self.latency:
+                time.sleep(self.latency * latency)
+            return self.replayed(rpc_request, records)
+
+        start = time.monotonic()
+        try:
+            response = send()
+        except Exception as e:
+            self.record(channel, json.loads(request_data), error=e, latency=time.monotonic() - start)
+            raise
+
+        self.record(channel, json.loads(request_data), response, latency=time.monotonic() - start)
+        return response
+
+    async def async_call(self, channel, request_data, send):
+
+        # same as call for a coroutine function send
+        if self.replay:
+            rpc_request, records, latency = self.lookup(channel, request_data)
+            if self.latency:
+                await asyncio.sleep(self.latency * latency)
+            return self.replayed(rpc_request, records)
+
+        start = time.monotonic()
+        try:
+            response = await send()
+        except Exception as e:
+            self.record(channel, json.loads(request_data), error=e, latency=time.monotonic() - start)
+            raise
+
+        self.record(channel, json.loads(request_data), response, latency=time.monotonic() - start)
+        return response
+
+    def close(self):
+
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -5,6 +5,21 @@ from pathlib import Path
 import argparse
 import csv
 import math
+import time
+import random
+import copy
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+
+from rpc import ClientRegistry, BatchCaller
+from async_rpc import AsyncRPCBackend
+from scheduler import RequestScheduler
+from scanner import LogScanner, BlockRangeScanner, ChunkSizeController
+from multicall import Multicall, MULTICALL_ADDRESS
+from cache import LogCache, StateStore, CodeStore
+from positions import PositionTracker, PositionSeries, POSITION_EVENTS
+from vaults import VaultClassifier, minimal_proxy_target
+from cassette import Cassette
 
 
 class VaultDetection(object):
@@ -12,14 +27,59 @@ class VaultDetection(object):
     CONFIG_FNAME = '{}/config.json'.format(str(Path().absolute()))
     CHUNK_SIZE = 4999
     N_BLOCKS = CHUNK_SIZE
-
-    def __init__(self, verbose, eth_node_url, bsc_node_url):
+    # blocks behind the chain head after which logs are not expected to change
+    FINALITY_DEPTH = {'eth': 64, 'bsc': 32}
+    CHECKPOINT_INTERVAL = 60
+    VERIFY_SAMPLE = 100
+    N_ENTRIES = 4
+    ENTRIES_PER_NODE = 2
+    # shared scans of more pids fetch every pid's logs instead of an OR over the pids
+    MAX_SHARED_PIDS = 32
+    USERS_INFO_COLUMNS = ['address', 'amount_pct', 'balance_usd', 'is_contract', 'contract_type', 'proxy']
+
+    def __init__(self, verbose, eth_node_url, bsc_node_url, pool_size=ClientRegistry.POOL_SIZE, n_workers=BlockRangeScanner.N_WORKERS,
+                 batch_size=BatchCaller.BATCH_SIZE, use_multicall=False, cache_fname=LogCache.CACHE_FNAME,
+                 state_fname=StateStore.STATE_FNAME, incremental=False, resume=False, positions=False, at_blocks=None, snapshot_series=None,
+                 n_entries=N_ENTRIES, entries_per_node=ENTRIES_PER_NODE, all_pools=False, code_fname=CodeStore.CODE_FNAME,
+                 async_rpc=False, max_in_flight=AsyncRPCBackend.MAX_IN_FLIGHT, rate=None, burst=None, hedge=False, record=None, replay=None,
+                 replay_latency=0.0):
         self.contract_info = None
+        self.snapshot_block = None
+        self.pbar_position = 0
 
         self.verbose = verbose
+        self.default_n_workers = n_workers
+        self.default_batch_size = batch_size
+        self.use_multicall = use_multicall
         self.eth_node_url = eth_node_url
         self.bsc_node_url = bsc_node_url
 
+        async_backend = AsyncRPCBackend(pool_size, max_in_flight) if async_rpc else None
+        scheduler = RequestScheduler(rate, burst, verbose=verbose)
+        # json-rpc traffic is recorded to, or replayed from, a cassette file
+        cassette = Cassette(replay, replay=True, latency=replay_latency, verbose=verbose) if replay else Cassette(record) if record else None
+        self.clients = ClientRegistry({'eth': eth_node_url, 'bsc': bsc_node_url}, pool_size=pool_size, async_backend=async_backend, scheduler=scheduler,
+                                      hedge=hedge, cassette=cassette, verbose=verbose)
+        self.chunk_controllers = dict()
+        self.log_cache = LogCache(cache_fname) if cache_fname else None
+        self.state_store = StateStore(state_fname)
+        self.code_store = CodeStore(code_fname)
+        self.incremental = incremental
+        self.resume = resume
+        self.positions = positions
+        self.at_blocks = at_blocks
+        self.snapshot_series = snapshot_series
+        self.all_pools = all_pools
+
+        # config entries run concurrently, at most entries_per_node of them against the same node
+        self.n_entries = max(n_entries, 1)
+        if record or replay:
+            # concurrent entries would take their chain heads and shared code store reads in a different order on every run
+            self.n_entries = 1
+        self.entries_per_node = max(entries_per_node, 1)
+        self.stop_event = threading.Event()
+        self._lock = threading.Lock()
+
     def get_contracts_info(self):
 
         with open(self.CONFIG_FNAME) as f:
@@ -30,14 +90,7 @@ class VaultDetection(object):
 
         contract_info = self.contract_info
         assert 'blockchain' in contract_info, 'Please add blockchain name to contract_info.json'
-        blockchain = contract_info['blockchain']
-
-        if blockchain.lower() == 'eth':
-            return Web3(Web3.HTTPProvider(self.eth_node_url))
-        elif blockchain.lower() == 'bsc':
-            return Web3(Web3.HTTPProvider(self.bsc_node_url))
-        else:
-            raise TypeError('unsupported blockchain {}'.format(blockchain))
+        return self.clients.w3(contract_info['blockchain'])
 
     @property
     def pid(self):
@@ -54,19 +107,99 @@ class VaultDetection(object):
     def n_blocks(self):
         return self.contract_info.get('n_blocks') or self.N_BLOCKS
 
+    @property
+    def n_workers(self):
+        return self.contract_info.get('n_workers') or self.default_n_workers
+
+    @property
+    def scan_workers(self):
+        # chunk sizes adapt in the order the workers finish, so log scans are recorded and replayed by a single worker
+        return 1 if self.clients.cassette is not None else self.n_workers
+
+    @property
+    def batch_size(self):
+        return self.contract_info.get('batch_size') or self.default_batch_size
+
+    @property
+    def batch_caller(self):
+        return BatchCaller(self.w3, batch_size=self.batch_size, n_workers=self.n_workers, verbose=self.verbose)
+
+    @property
+    def multicall_address(self):
+        return self.contract_info.get('multicall_address') or MULTICALL_ADDRESS
+
+    @property
+    def state_reader(self):
+
+        # contract reads go either through plain json-rpc batches or through the chain's multicall contract
+        if self.use_multicall:
+            return Multicall(self.batch_caller, self.multicall_address)
+        return self.batch_caller
+
     @property
     def min_amount(self):
         return self.contract_info.get('min_amount') or 0
 
     @property
     def contract(self):
-        return self.w3.eth.contract(address=Web3.toChecksumAddress(self.contract_info['address']), abi=self.contract_info['abi'])
+        return self.clients.contract(self.contract_info['blockchain'], self.contract_info['address'], self.contract_info['abi'])
+
+    @property
+    def chunk_controller(self):
+
+        # chunk sizes that worked are shared by every config entry scanning the same contract on the same node
+        key = (self.clients.node_url(self.contract_info['blockchain']), self.contract.address)
+        with self._lock:
+            if key not in self.chunk_controllers:
+                self.chunk_controllers[key] = ChunkSizeController(self.chunk_size)
+
+            controller = self.chunk_controllers[key]
+        controller.max_size = self.chunk_size
+        controller.size = min(controller.size, controller.max_size)
+        return controller
 
     def get_contract(self, address, abi):
-        return self.w3.eth.contract(address=address, abi=abi)
+        return self.clients.contract(self.contract_info['blockchain'], address, abi)
+
+    def get_codes(self, addresses):
+
+        # {address: (code_hash, code_size, minimal proxy target)} at the snapshot block. known addresses come from the code store,
+        # the others are read in json-rpc batches of eth_getCode and only their code hash and size are stored. an address seen
+        # with code after the snapshot block may not have been deployed yet at that block, so it is read again
+        blockchain = self.contract_info['blockchain']
+        codes = {address: code for address, (block_number, *code) in self.code_store.get_codes(blockchain, addresses).items()
+                 if not code[1] or block_number <= self.snapshot_block}
+
+        missing = [address for address in dict.fromkeys(addresses) if address not in codes]
+        if not missing:
+            return codes
 
-    def is_contract(self, addr):
-        return self.w3.eth.getCode(addr) != b''
+        batch_caller = self.batch_caller
+        with tqdm(total=len(missing), desc='[{}] Fetching Codes: '.format(self.contract_info['name']), position=self.pbar_position) as pbar:
+            results = batch_caller.request([('eth_getCode', [address, batch_caller.block_param(self.snapshot_block)]) for address in missing], progress=pbar.update)
+
+        fetched = {address: (Web3.keccak(hexstr=code).hex(), len(code) // 2 - 1, minimal_proxy_target(code)) for address, code in zip(missing, results)}
+        self.code_store.add(blockchain, {address: (self.snapshot_block,) + code for address, code in fetched.items()})
+
+        codes.update(fetched)
+        return {address: tuple(code) for address, code in codes.items()}
+
+    def classify_contracts(self, codes):
+
+        # {address: (proxy, contract type)} of the contracts among codes
+        contracts = {address: code for address, code in codes.items() if code[1] > 0}
+        if not contracts:
+            return dict()
+
+        classifier = VaultClassifier(self.batch_caller, self.state_reader, self.code_store, self.contract_info['blockchain'], self.snapshot_block)
+        classes = classifier.classify(contracts)
+
+        if self.verbose >= 1:
+            contract_types = [contract_type for proxy, contract_type in classes.values()]
+            print('[{}] {} contract depositors, {} vaults, {} strategies'.format(
+                self.contract_info['name'], len(classes), contract_types.count('vault'), contract_types.count('strategy')))
+
+        return classes
 
     @staticmethod
     def millify(n):
@@ -77,15 +210,17 @@ class VaultDetection(object):
 
         return '{:.0f}{}'.format(n / 10**(3 * millidx), millnames[millidx])
 
-    def csv_writer(self, row_names, data):
+    def csv_writer(self, row_names, data, name=None):
 
         if data:
             assert len(row_names) == len(data[0])
 
+        name = name or self.contract_info['name']
+
         if self.verbose >= 1:
-            print('[{}][Write CSV] writing data to csv file'.format(self.contract_info['name']))
+            print('[{}][Write CSV] writing data to {}.csv'.format(self.contract_info['name'], name))
 
-        with open('{}/{}.csv'.format(str(Path.home()), self.contract_info['name']), 'w') as out:
+        with open('{}/{}.csv'.format(str(Path.home()), name), 'w') as out:
 
             csv_out = csv.writer(out)
             csv_out.writerow(row_names)
@@ -93,127 +228,625 @@ class VaultDetection(object):
             for row in data:
                 csv_out.writerow(row)
 
-    def get_lp_ref_reserve(self, lp_contract):
+    def get_lp_ref_reserve(self, lp_reserves, lp_info=None):
 
-        # get reserves
-        lp_reserves = lp_contract.functions.getReserves().call()
-        ref_token = self.contract_info['lp']['ref_token']
+        ref_token = (lp_info or self.contract_info['lp'])['ref_token']
 
         assert ref_token < 2, 'ref_token should be 0 or 1 ({})'.format(ref_token)
         assert len(lp_reserves) == 3, 'unexpected length of getReserves ({})'.format(len(lp_reserves))
 
         return lp_reserves[ref_token]
 
-    def get_master_chef_balance(self):
-        lp_address, _, _, _ = self.contract.functions.poolInfo(self.pid).call()
-        assert lp_address == self.contract_info['lp']['address'], 'please update lp address and abi in contract info (lp_address={})'.format(lp_address)
-        lp_address = self.contract_info['lp']['address']
-        lp_contract = self.get_contract(lp_address, self.contract_info['lp']['abi'])
-        # get the balance of master-chef in lp contract
-        master_chef_lp = lp_contract.functions.balanceOf(Web3.toChecksumAddress(self.contract_info['address'])).call()
-        total_supply_lp = lp_contract.functions.totalSupply().call()
-
-        lp_ref_reserve = self.get_lp_ref_reserve(lp_contract)
-        norm_factor = self.contract_info['lp']['norm_factor']
-        # master-chef balance in usd
-        master_chef_balance_usd = 2 * lp_ref_reserve * (master_chef_lp / total_supply_lp) / norm_factor
+    def lp_functions(self, lp_info):
+
+        # the balance of master-chef in lp contract, lp supply and, for pairs priced against the reference token, the reserves
+        lp_contract = self.get_contract(lp_info['address'], lp_info['abi'])
+        functions = [lp_contract.functions.balanceOf(Web3.toChecksumAddress(self.contract_info['address'])), lp_contract.functions.totalSupply()]
+
+        if lp_info.get('ref_token') is not None:
+            functions.append(lp_contract.functions.getReserves())
+        return functions
+
+    def price_master_chef_balance(self, lp_info, master_chef_lp, total_supply_lp, lp_reserves=None):
+
+        # master-chef balance in usd, None for pools that are not priced
+        if lp_info.get('ref_token') is None:
+            return None, master_chef_lp
+
+        lp_ref_reserve = self.get_lp_ref_reserve(lp_reserves, lp_info)
+        master_chef_balance_usd = 2 * lp_ref_reserve * (master_chef_lp / total_supply_lp) / lp_info['norm_factor'] if total_supply_lp else 0
         return master_chef_balance_usd, master_chef_lp
 
+    def get_master_chef_balance(self):
+
+        # pools enumerated by get_pools come with their balance at the snapshot block
+        master_chef_balances = self.contract_info.get('master_chef_balances', dict())
+        if self.snapshot_block in master_chef_balances:
+            return master_chef_balances[self.snapshot_block]
+
+        lp_info = self.contract_info['lp']
+
+        # pool info, the balance of master-chef in lp contract, lp supply and reserves in a single round-trip
+        pool_info, *lp_state = self.state_reader.call_functions([self.contract.functions.poolInfo(self.pid)] + self.lp_functions(lp_info),
+                                                                self.snapshot_block)
+
+        assert pool_info[0] == lp_info['address'], 'please update lp address and abi in contract info (lp_address={})'.format(pool_info[0])
+
+        return self.price_master_chef_balance(lp_info, *lp_state)
+
+    def get_pools(self, contract_info):
+
+        # every pool of the entry's master-chef as an entry of its own, all read at one snapshot block in a few batched
+        # round-trips. lp contracts come from poolInfo, pairs holding the configured pair's reference token are priced against it
+        self.contract_info = contract_info
+        self.snapshot_block = self.end_block
+        state_reader = self.state_reader
+        lp_abi = contract_info['lp']['abi']
+
+        n_pools = state_reader.call_functions([self.contract.functions.poolLength()], self.snapshot_block)[0]
+        lp_addresses = [pool_info[0] for pool_info in state_reader.call_functions(
+            [self.contract.functions.poolInfo(pid) for pid in range(n_pools)], self.snapshot_block)]
+
+        ref_lp_contract = self.get_contract(contract_info['lp']['address'], lp_abi)
+        ref_token_address = state_reader.call_functions([ref_lp_contract.functions.token0(), ref_lp_contract.functions.token1()],
+                                                        self.snapshot_block)[contract_info['lp']['ref_token']]
+
+        # single token pools have no token0 and token1
+        lp_contracts = [self.get_contract(lp_address, lp_abi) for lp_address in lp_addresses]
+        tokens = state_reader.call_functions([function for lp_contract in lp_contracts for function in (lp_contract.functions.token0(), lp_contract.functions.token1())],
+                                             self.snapshot_block, allow_failure=True)
+
+        # the position scans of every pool start at the same block, searched for at most once
+        start_block = dict() if self.scan_events == 'Deposit' else {'start_block': self.start_block}
+
+        pools = list()
+        for pid, lp_address in enumerate(lp_addresses):
+
+            pair_tokens = tokens[2 * pid:2 * pid + 2]
+            ref_token = pair_tokens.index(ref_token_address) if ref_token_address in pair_tokens else None
+
+            pools.append(dict(contract_info, name='{}_pid{}'.format(contract_info['name'], pid), pid=pid, end_block=self.snapshot_block,
+                              lp=dict(contract_info['lp'], address=lp_address, ref_token=ref_token), **start_block))
+
+        lp_functions = [self.lp_functions(pool['lp']) for pool in pools]
+        lp_states = iter(state_reader.call_functions([function for functions in lp_functions for function in functions], self.snapshot_block))
+
+        for pool, functions in zip(pools, lp_functions):
+            pool['master_chef_balances'] = {self.snapshot_block: self.price_master_chef_balance(pool['lp'], *[next(lp_states) for _ in functions])}
+
+        if self.verbose >= 1:
+            print('[{}] {} pools, {} priced against {}'.format(contract_info['name'], len(pools), sum(pool['lp']['ref_token'] is not None for pool in pools),
+                                                            ref_token_address))
+
+        return pools
+
+    @property
+    def finality_depth(self):
+        return self.FINALITY_DEPTH.get(self.contract_info['blockchain'].lower(), max(self.FINALITY_DEPTH.values()))
+
+    @property
+    def finalized_block(self):
+        return self.w3.eth.blockNumber - self.finality_depth
+
     @property
     def end_block(self):
         return self.w3.eth.blockNumber if 'end_block' not in self.contract_info else self.contract_info['end_block']
 
-    def main(self):
+    @property
+    def start_block(self):
+        return self.contract_info['start_block'] if 'start_block' in self.contract_info else self.find_deployment_block()
 
-        contracts_info = self.get_contracts_info()
+    def find_deployment_block(self):
 
-        for i in range(len(contracts_info)):
+        # binary search for the first block with master-chef code, needs an archive node
+        if self.verbose >= 1:
+            print('[{}] Searching for the deployment block, add start_block to config.json to skip this'.format(self.contract_info['name']))
 
-            self.contract_info = contracts_info[i]
-            if self.verbose >= 1:
-                print('Running on contract {} ...'.format(self.contract_info['name']))
+        low, high = 0, self.snapshot_block
+        while low < high:
+            mid = (low + high) // 2
+            if self.w3.eth.getCode(self.contract.address, block_identifier=mid) == b'':
+                low = mid + 1
+            else:
+                high = mid
+
+        return low
+
+    @property
+    def state_key(self):
+        return StateStore.make_key(self.contract_info)
+
+    @property
+    def positions_state_key(self):
+        return StateStore.make_key(self.contract_info, 'positions')
+
+    def scan_entries(self, log_scanner, first_block, last_block, apply, state, description, checkpoint_key=None, next_block=None):
+
+        # applies every log in [first_block, last_block] walking from the newest block backwards, starting at
+        # next_block when continuing a checkpoint. progress and state are checkpointed under checkpoint_key
+        next_block = last_block if next_block is None else next_block
+        range_scanner = BlockRangeScanner(log_scanner.get_entries, n_workers=self.scan_workers, verbose=self.verbose)
+        checkpoint = {'next_block': next_block, 'time': time.time()}
+
+        def save_checkpoint():
+            if checkpoint_key is not None:
+                self.state_store.save_checkpoint(checkpoint_key, first_block, last_block, checkpoint['next_block'], self.snapshot_block, state)
+            checkpoint['time'] = time.time()
+
+        total_pbar = next_block-first_block+1
+        with tqdm(total=total_pbar, position=self.pbar_position) as pbar:
+
+            pbar.set_description("[{}] {}: ".format(self.contract_info['name'], description))
+
+            def on_chunk(from_block, to_block, entries):
+
+                # another entry's thread cannot be interrupted directly, it stops (and checkpoints) at its next chunk
+                if self.stop_event.is_set():
+                    raise KeyboardInterrupt
+
+                for entry in entries:
+                    apply(entry)
+
+                if self.verbose >= 2:
+                    print(state)
+
+                pbar.update(to_block - from_block + 1)
+
+                checkpoint['next_block'] = from_block - 1
+                if time.time() - checkpoint['time'] >= self.CHECKPOINT_INTERVAL:
+                    save_checkpoint()
+
+            try:
+                self.scan_ranges(log_scanner, range_scanner, first_block, next_block, on_chunk)
+            except BaseException:
+                # includes KeyboardInterrupt, everything released to on_chunk so far is consistent
+                save_checkpoint()
+                raise
+
+        if checkpoint_key is not None:
+            self.state_store.clear_checkpoint(checkpoint_key)
+
+        return state
+
+    def get_deposits(self, first_block, last_block, all_deposits=None, next_block=None):
+
+        # first deposit amount per user in [first_block, last_block]
+        all_deposits = dict() if all_deposits is None else all_deposits
+        deposit_scanner = LogScanner(self.contract, 'Deposit', argument_filters={'pid': self.pid})
+
+        def apply(entry):
+            if entry.user not in all_deposits.keys():
+                all_deposits[entry.user] = entry.amount
+
+        return self.scan_entries(deposit_scanner, first_block, last_block, apply, all_deposits, 'Filter Deposits',
+                                 checkpoint_key=self.state_key, next_block=next_block)
+
+    def get_positions(self, first_block, last_block, balances=None, checkpoint_key=None, next_block=None):
+
+        # net staked amount per user from the Deposit, Withdraw and EmergencyWithdraw events in [first_block, last_block]
+        position_tracker = PositionTracker(balances)
+        position_scanner = LogScanner(self.contract, POSITION_EVENTS, argument_filters={'pid': self.pid})
+
+        return self.scan_entries(position_scanner, first_block, last_block, position_tracker.apply, position_tracker.balances, 'Filter Positions',
+                                 checkpoint_key=checkpoint_key, next_block=next_block)
+
+    def scan_ranges(self, log_scanner, range_scanner, first_block, last_block, on_chunk):
+
+        if self.log_cache is None:
+            range_scanner.scan(first_block, last_block, self.chunk_controller, on_chunk)
 
-            if not self.contract_info['enabled']:
+        else:
+            cache_key = LogCache.make_key(self.contract_info['blockchain'], log_scanner.contract.address, log_scanner.topics)
+            finalized_block = self.finalized_block
+
+            def on_scanned_chunk(from_block, to_block, entries):
+                # only the finalized part of a chunk is cached
+                self.log_cache.add(cache_key, from_block, min(to_block, finalized_block), entries)
+                on_chunk(from_block, to_block, entries)
+
+            # cached segments are replayed and only the gaps are fetched, still newest first
+            for from_block, to_block, is_cached in self.log_cache.segments(cache_key, first_block, last_block):
+                if is_cached:
+                    on_chunk(from_block, to_block, self.log_cache.get_entries(cache_key, from_block, to_block, log_scanner.entry_type))
+                else:
+                    range_scanner.scan(from_block, to_block, self.chunk_controller, on_scanned_chunk)
+
+            self.log_cache.compact(cache_key)
+
+    def find_depositors(self):
+
+        to_block = self.snapshot_block
+        first_block = to_block - self.n_blocks
+
+        assert self.n_blocks >= self.chunk_size, 'n_blocks ({}) is expected to be >= chunk_size ({})'.format(self.n_blocks, self.chunk_size)
+
+        previous_deposits = dict()
+        if self.incremental:
+
+            # resume a little before the last scanned block in case its newest blocks were reorganized
+            last_block, previous_deposits = self.state_store.get_scan(self.state_key)
+            if last_block is not None:
+                first_block = min(to_block + 1, last_block + 1 - self.finality_depth)
                 if self.verbose >= 1:
-                    print('{} is disabled, skipping contract\n'.format(self.contract_info['name']))
-                continue
+                    print('[{}] Incremental scan from block {} ({} known depositors)'.format(self.contract_info['name'], first_block, len(previous_deposits)))
+
+        checkpoint = self.state_store.get_checkpoint(self.state_key) if self.resume else None
+        if checkpoint is not None:
+
+            # continue the interrupted scan on its own snapshot block
+            first_block, to_block, next_block, self.snapshot_block, checkpoint_deposits = checkpoint
+            if self.verbose >= 1:
+                print('[{}] Resuming scan of snapshot block {} from block {}'.format(self.contract_info['name'], self.snapshot_block, next_block))
+
+            all_deposits = self.get_deposits(first_block, to_block, checkpoint_deposits, next_block)
+        else:
+            all_deposits = self.get_deposits(first_block, to_block)
+
+        for user, amount in previous_deposits.items():
+            if user not in all_deposits.keys():
+                all_deposits[user] = amount
+
+        if self.incremental:
+            self.state_store.save_scan(self.state_key, to_block, all_deposits)
+
+        return all_deposits
+
+    def find_positions(self):
+
+        # the finalized part of the history is scanned (and stored for incremental runs) separately from the newest blocks,
+        # so a later incremental run can simply add the events after it
+        key = self.positions_state_key
+
+        checkpoint = self.state_store.get_checkpoint(key) if self.resume else None
+        if checkpoint is not None:
+
+            first_block, finalized_block, next_block, self.snapshot_block, balances = checkpoint
+            if self.verbose >= 1:
+                print('[{}] Resuming scan of snapshot block {} from block {}'.format(self.contract_info['name'], self.snapshot_block, next_block))
+
+            balances = self.get_positions(first_block, finalized_block, balances, key, next_block)
+        else:
+            finalized_block = min(self.snapshot_block, self.finalized_block)
+
+            last_block, balances = self.state_store.get_scan(key) if self.incremental else (None, dict())
+            first_block = self.start_block if last_block is None else last_block + 1
+            if last_block is not None and self.verbose >= 1:
+                print('[{}] Incremental scan from block {} ({} known users)'.format(self.contract_info['name'], first_block, len(balances)))
+
+            balances = self.get_positions(first_block, finalized_block, balances, key)
+
+        if self.incremental and finalized_block >= first_block:
+            self.state_store.save_scan(key, finalized_block, balances)
+
+        return self.get_positions(max(first_block, finalized_block + 1), self.snapshot_block, dict(balances))
+
+    def get_user_amounts(self, addresses):
+
+        with tqdm(total=len(addresses), desc='[{}] Fetching User info: '.format(self.contract_info['name']), position=self.pbar_position) as pbar:
+            user_infos = self.state_reader.call_functions(
+                [self.contract.functions.userInfo(self.pid, addr) for addr in addresses], self.snapshot_block, progress=pbar.update)
+
+        return [amount for amount, reward_debt in user_infos]
+
+    def sample_position_mismatches(self, balances):
+
+        # compares a sample of the reconstructed balances with userInfo at the snapshot block, e.g. forks with
+        # deposit fees stake less than the Deposit amount. the sample is seeded with the snapshot block, so recorded runs replay
+        sample = random.Random(self.snapshot_block).sample(sorted(balances), min(self.VERIFY_SAMPLE, len(balances)))
+        mismatches = [addr for addr, amount in zip(sample, self.get_user_amounts(sample)) if amount != max(balances[addr], 0)]
+
+        if mismatches and self.verbose >= 1:
+            print('[{}] {} of {} sampled positions differ from userInfo at block {}'.format(
+                self.contract_info['name'], len(mismatches), len(sample), self.snapshot_block))
+
+        return mismatches
+
+    def verify_positions(self, balances):
+
+        # on any sampled mismatch every user's amount is read from userInfo instead
+        if not self.sample_position_mismatches(balances):
+            return balances
+
+        if self.verbose >= 1:
+            print('[{}] Fetching user info of all {} users'.format(self.contract_info['name'], len(balances)))
+
+        addresses = list(balances.keys())
+        return dict(zip(addresses, self.get_user_amounts(addresses)))
+
+    @property
+    def target_blocks(self):
+
+        # explicit --at_block heights, or --snapshot_series count:step blocks ending at end_block
+        if self.at_blocks:
+            return sorted(self.at_blocks)
+
+        if self.snapshot_series:
+            count, step = self.snapshot_series
+            end_block = self.end_block
+            return sorted(end_block - i * step for i in range(count))
+
+        return None
+
+    def get_position_series(self, target_blocks):
+
+        # one pass over the position events up to the newest target, balances are then rebuilt at every target
+        position_series = PositionSeries(target_blocks)
+        position_scanner = LogScanner(self.contract, POSITION_EVENTS, argument_filters={'pid': self.pid})
 
-            to_block = self.end_block
+        self.scan_entries(position_scanner, self.start_block, position_series.target_blocks[-1], position_series.apply,
+                          position_series.deltas, 'Filter Positions')
 
-            first_block = to_block - self.n_blocks
-            from_block = to_block-self.chunk_size
+        return position_series.snapshots()
 
-            assert self.n_blocks >= self.chunk_size, 'n_blocks ({}) is expected to be >= chunk_size ({})'.format(self.n_blocks, self.chunk_size)
+    def write_snapshot_series(self, target_blocks):
 
-            all_deposits = dict()
-            chunk_size = self.chunk_size
+        # the state reads of every snapshot are pinned to its own block, so this needs an archive node for old targets
+        self.snapshot_block = target_blocks[-1]
 
-            total_pbar = to_block-first_block
-            with tqdm(total=total_pbar) as pbar:
+        for target_block, balances in self.get_position_series(target_blocks):
 
-                pbar.set_description("[{}] Filter Deposits: ".format(self.contract_info['name']))
+            self.snapshot_block = target_block
+            if target_block == target_blocks[-1]:
+                self.sample_position_mismatches(balances)
 
-                while True:
+            addresses = [addr for addr, amount in balances.items() if amount > 0]
+            self.write_users_info(addresses, [balances[addr] for addr in addresses], '{}_{}'.format(self.contract_info['name'], target_block))
 
-                    if self.verbose >= 2:
-                        print('chunk_size={}, from_block={}, to_block={}'.format(chunk_size, from_block, to_block))
+    def write_users_info(self, addresses, amounts, name=None):
 
-                    deposit_filter = self.contract.events.Deposit.createFilter(
-                        fromBlock=from_block, toBlock=to_block, argument_filters={'pid': self.pid})
+        master_chef_balance_usd, master_chef_lp = self.get_master_chef_balance()
 
-                    try:
-                        for entry in deposit_filter.get_all_entries():
-                            if entry['args']['user'] not in all_deposits.keys():
-                                all_deposits[entry['args']['user']] = entry['args']['amount']
+        if self.verbose >= 2:
+            print('master_chef_balance_usd = {}, master_chef_lp = {}'.format(master_chef_balance_usd, master_chef_lp))
 
-                        if self.verbose >= 2:
-                            print(all_deposits)
+        codes = self.get_codes([addr for addr, amount in zip(addresses, amounts) if amount > 0])
+        classes = self.classify_contracts(codes)
+        users_info = self.make_users_info(addresses, amounts, master_chef_balance_usd, master_chef_lp, codes, classes)
 
-                    except Exception as e:
+        if self.verbose >= 1:
+            print('[{}] Sorting results by user info amount...'.format(self.contract_info['name']))
+
+        users_info = sorted(users_info, key=lambda x: x[1], reverse=True)
+        self.csv_writer(self.USERS_INFO_COLUMNS, users_info, name)
+
+    def make_users_info(self, addresses, amounts, master_chef_balance_usd, master_chef_lp, codes, classes):
 
-                        # TODO: rate limit, chunk too big  (e.args[0]['code'] == -32603)
-                        if self.verbose >= 2:
-                            print(e)
+        # one USERS_INFO_COLUMNS row per user with a positive amount
+        users_info = list()
+        for addr, amount in zip(addresses, amounts):
 
-                        chunk_size = max(chunk_size // 2, 1)
-                        from_block = to_block - chunk_size
-                        continue
+            if amount <= 0:
+                continue
+
+            balance_usd = '' if master_chef_balance_usd is None else self.millify(master_chef_balance_usd * amount / master_chef_lp)
+            proxy, contract_type = classes.get(addr, ('', ''))
+            users_info.append((addr, 100 * amount / master_chef_lp, balance_usd, codes[addr][1] > 0, contract_type, proxy))
 
-                    pbar.update(to_block-from_block)
+        return users_info
 
-                    to_block = from_block - 1
-                    from_block = max(first_block, from_block-chunk_size)
-                    chunk_size = self.chunk_size
+    def node_capacity(self, contract_info):
+        # a node pool takes entries_per_node entries per endpoint
+        return self.entries_per_node * len(self.clients.endpoints(contract_info['blockchain']))
 
-                    if from_block <= first_block:
-                        break
+    def run_contract(self, contract_info, pbar_position=0):
 
-            pbar.close()
-            _deposits = all_deposits
+        # every entry runs on its own shallow copy, sharing clients, caches and stores but not the per-entry state
+        vault_detection = copy.copy(self)
+        vault_detection.contract_info = contract_info
+        vault_detection.snapshot_block = None
+        vault_detection.pbar_position = pbar_position
 
-            master_chef_balance_usd, master_chef_lp = self.get_master_chef_balance()
+        vault_detection.process_contract()
 
-            if self.verbose >= 2:
-                print('master_chef_balance_usd = {}, master_chef_lp = {}'.format(master_chef_balance_usd, master_chef_lp))
+    def run_contracts(self, executor, contracts_info, futures):
 
-            users_info = list()
+        # entries are submitted in config order once their node has capacity, so entries waiting for a busy node do not
+        # hold executor threads that entries of other nodes could use. every running entry gets a free progress bar position.
+        # futures is filled with the running entries, returns the names of the failed entries
+        failed = list()
+        pending = list()
+        for contract_info in contracts_info:
+            try:
+                pending.append((contract_info, self.clients.node_url(contract_info['blockchain']), self.node_capacity(contract_info)))
+            except Exception as e:
+                failed.append(contract_info['name'])
+                print('[{}] failed: {!r}'.format(contract_info['name'], e))
 
-            for addr in tqdm(list(_deposits.keys()), desc='[{}] Fetching User info: '.format(self.contract_info['name'])):
+        running = dict()
+        positions = list(range(self.n_entries))
 
-                amount, reward_debt = self.contract.functions.userInfo(self.pid, addr).call()
+        while pending or futures:
 
-                if amount == 0:
+            for entry in list(pending):
+                contract_info, node_url, capacity = entry
+                if not positions:
+                    break
+                if running.get(node_url, 0) >= capacity:
                     continue
 
-                users_info.append((addr, 100 * amount / master_chef_lp, self.millify(master_chef_balance_usd * amount / master_chef_lp),
-                                   self.is_contract(addr)))
+                pending.remove(entry)
+                running[node_url] = running.get(node_url, 0) + 1
+                position = positions.pop(0)
+                futures[executor.submit(self.run_contract, contract_info, position)] = (contract_info['name'], node_url, position)
 
-            if self.verbose >= 1:
-                print('[{}] Sorting results by user info amount...'.format(self.contract_info['name']))
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+
+                name, node_url, position = futures.pop(future)
+                running[node_url] -= 1
+                positions = sorted(positions + [position])
+
+                try:
+                    future.result()
+                except Exception as e:
+                    failed.append(name)
+                    print('[{}] failed: {!r}'.format(name, e))
+
+        return failed
+
+    def process_contract(self):
+
+        if self.verbose >= 1:
+            print('Running on contract {} ...'.format(self.contract_info['name']))
+
+        target_blocks = self.target_blocks
+        if target_blocks:
+            self.write_snapshot_series(target_blocks)
+            return
+
+        # every state read of this contract is pinned to the block the deposit scan ends at
+        self.snapshot_block = self.end_block
+        if self.verbose >= 1:
+            print('[{}] Snapshot block {}'.format(self.contract_info['name'], self.snapshot_block))
+
+        if self.positions:
+            amounts = self.verify_positions(self.find_positions())
+            addresses = list(amounts.keys())
+            amounts = [amounts[addr] for addr in addresses]
+        else:
+            addresses = list(self.find_depositors().keys())
+            amounts = self.get_user_amounts(addresses)
+
+        self.write_users_info(addresses, amounts)
+
+    @property
+    def scan_events(self):
+        return POSITION_EVENTS if self.positions or self.at_blocks or self.snapshot_series else 'Deposit'
+
+    @property
+    def scan_range(self):
+
+        # blocks this entry needs, ignoring incremental state (already scanned ranges are cached anyway)
+        last_block = self.end_block
+        if self.scan_events == 'Deposit':
+            return last_block - self.n_blocks, last_block
+
+        self.snapshot_block = last_block
+        return self.start_block, last_block
 
-            users_info = sorted(users_info, key=lambda x: x[1], reverse=True)
-            self.csv_writer(['address', 'amount_pct', 'balance_usd', 'is_contract'], users_info)
+    def prefetch_shared_logs(self, contracts_info):
+
+        # all entries of one master-chef are scanned once with an OR over their pids (or without a pid filter when there
+        # are many), the logs are split by pid into each entry's own cache namespace, from which the entries then replay their range
+        self.contract_info = contracts_info[0]
+        pids = sorted(set(info['pid'] for info in contracts_info))
+        log_scanner = LogScanner(self.contract, self.scan_events, argument_filters={'pid': pids if len(pids) <= self.MAX_SHARED_PIDS else None})
+        range_scanner = BlockRangeScanner(log_scanner.get_entries, n_workers=self.scan_workers, verbose=self.verbose)
+
+        pid_keys = dict()
+        gaps = list()
+        for contract_info in contracts_info:
+
+            self.contract_info = contract_info
+            pid_scanner = LogScanner(self.contract, self.scan_events, argument_filters={'pid': self.pid})
+            pid_keys[self.pid] = LogCache.make_key(self.contract_info['blockchain'], pid_scanner.contract.address, pid_scanner.topics)
+
+            first_block, last_block = self.scan_range
+            gaps += [(from_block, to_block) for from_block, to_block, is_cached in self.log_cache.segments(pid_keys[self.pid], first_block, last_block)
+                     if not is_cached]
+
+        # union of every entry's uncached ranges
+        merged = list()
+        for from_block, to_block in sorted(gaps):
+            if merged and from_block <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], to_block)
+            else:
+                merged.append([from_block, to_block])
+
+        finalized_block = self.finalized_block
+
+        with tqdm(total=sum(to_block - from_block + 1 for from_block, to_block in merged), position=self.pbar_position) as pbar:
+
+            pbar.set_description('[{}] Shared scan of {} pids: '.format(self.contract.address, len(pid_keys)))
+
+            def on_chunk(from_block, to_block, entries):
+
+                if self.stop_event.is_set():
+                    raise KeyboardInterrupt
+
+                for pid, key in pid_keys.items():
+                    self.log_cache.add(key, from_block, min(to_block, finalized_block), [entry for entry in entries if entry.pid == pid])
+
+                pbar.update(to_block - from_block + 1)
+
+            for from_block, to_block in reversed(merged):
+                range_scanner.scan(from_block, to_block, self.chunk_controller, on_chunk)
+
+        for key in pid_keys.values():
+            self.log_cache.compact(key)
+
+    def shared_scan_groups(self, contracts_info):
+
+        # entries on the same chain and master-chef with different pids
+        groups = dict()
+        for contract_info in contracts_info:
+            groups.setdefault((contract_info['blockchain'].lower(), contract_info['address'].lower()), list()).append(contract_info)
+
+        return [group for group in groups.values() if len(set(contract_info['pid'] for contract_info in group)) > 1]
+
+    def main(self):
+
+        contracts_info = list()
+
+        for contract_info in self.get_contracts_info():
+
+            if not contract_info['enabled']:
+                if self.verbose >= 1:
+                    print('{} is disabled, skipping contract\n'.format(contract_info['name']))
+                continue
 
+            contracts_info.append(contract_info)
+
+        failed = list()
+
+        if self.all_pools:
+
+            # every pool of each configured master-chef, enumerated once per master-chef
+            master_chefs = dict()
+            for contract_info in contracts_info:
+                master_chefs.setdefault((contract_info['blockchain'].lower(), contract_info['address'].lower()), contract_info)
+
+            contracts_info = list()
+            for contract_info in master_chefs.values():
+                try:
+                    contracts_info += copy.copy(self).get_pools(contract_info)
+                except Exception as e:
+                    failed.append(contract_info['name'])
+                    print('[{}] failed to enumerate pools: {!r}'.format(contract_info['name'], e))
+
+        # a failing entry is reported without stopping the others
+        with ThreadPoolExecutor(max_workers=self.n_entries) as executor:
+
+            futures = dict()
+
+            try:
+                if self.log_cache is not None:
+                    futures = {executor.submit(copy.copy(self).prefetch_shared_logs, group): group for group in self.shared_scan_groups(contracts_info)}
+                    for future in as_completed(futures):
+                        try:
+                            future.result()
+                        except Exception as e:
+                            # the entries then scan their own pid
+                            print('shared scan of {} failed: {!r}'.format([info['name'] for info in futures[future]], e))
+
+                futures = dict()
+                failed += self.run_contracts(executor, contracts_info, futures)
+
+            except KeyboardInterrupt:
+                # running scans checkpoint and stop at their next chunk, queued entries are dropped
+                self.stop_event.set()
+                for future in futures:
+                    future.cancel()
+                raise
+
+        self.clients.close()
+        if self.log_cache is not None:
+            self.log_cache.close()
+        self.state_store.close()
+        self.code_store.close()
+
+        if failed:
+            print('failed contracts: {}'.format(', '.join(failed)))
         print('all done')
 
 
@@ -221,9 +854,40 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--verbose', required=False, help='[0, 1, 2] defaults to 1', default=1, type=int)
-    parser.add_argument('-e', '--eth_node_url', required=False, help='ethereum node url', default='https://eth-mainnet.alchemyapi.io/v2/Obg4PgciCH3QtWqr_CYqYmkEEBc93SSo')
-    parser.add_argument('-b', '--bsc_node_url', required=False, help='bsc node url', default='https://bsc-dataseed1.binance.org:443')
+    parser.add_argument('-e', '--eth_node_url', required=False, help='ethereum node url, or comma separated urls used as a node pool', default='https://eth-mainnet.alchemyapi.io/v2/Obg4PgciCH3QtWqr_CYqYmkEEBc93SSo')
+    parser.add_argument('-b', '--bsc_node_url', required=False, help='bsc node url, or comma separated urls used as a node pool', default='https://bsc-dataseed1.binance.org:443')
+    parser.add_argument('-p', '--pool_size', required=False, help='max open connections per node, defaults to {}'.format(ClientRegistry.POOL_SIZE), default=ClientRegistry.POOL_SIZE, type=int)
+    parser.add_argument('-w', '--n_workers', required=False, help='concurrent block range requests per contract, defaults to {}'.format(BlockRangeScanner.N_WORKERS), default=BlockRangeScanner.N_WORKERS, type=int)
+    parser.add_argument('-s', '--batch_size', required=False, help='calls per json-rpc batch request, defaults to {}'.format(BatchCaller.BATCH_SIZE), default=BatchCaller.BATCH_SIZE, type=int)
+    parser.add_argument('-m', '--multicall', required=False, help='aggregate contract reads through the multicall contract', action='store_true')
+    parser.add_argument('-c', '--cache_fname', required=False, help='sqlite file caching finalized deposit logs, defaults to {}'.format(LogCache.CACHE_FNAME), default=LogCache.CACHE_FNAME)
+    parser.add_argument('--no_cache', required=False, help='always fetch deposit logs from the node', action='store_true')
+    parser.add_argument('-i', '--incremental', required=False, help='only scan the blocks after the previous incremental run and merge its depositors', action='store_true')
+    parser.add_argument('-r', '--resume', required=False, help='continue interrupted deposit scans from their last checkpoint', action='store_true')
+    parser.add_argument('--state_fname', required=False, help='sqlite file keeping incremental run state and checkpoints, defaults to {}'.format(StateStore.STATE_FNAME), default=StateStore.STATE_FNAME)
+    parser.add_argument('--positions', required=False, help='compute user amounts from Deposit/Withdraw/EmergencyWithdraw events since start_block instead of userInfo', action='store_true')
+    parser.add_argument('--at_block', required=False, help='comma separated blocks to write position snapshots at ({name}_{block}.csv)', default=None,
+                        type=lambda blocks: [int(block) for block in blocks.split(',')])
+    parser.add_argument('--snapshot_series', required=False, help='count:step, position snapshots every step blocks ending at end_block, e.g. 90:28800', default=None,
+                        type=lambda series: tuple(int(n) for n in series.split(':')))
+    parser.add_argument('--n_entries', required=False, help='config entries running concurrently, defaults to {}'.format(VaultDetection.N_ENTRIES), default=VaultDetection.N_ENTRIES, type=int)
+    parser.add_argument('--entries_per_node', required=False, help='config entries running concurrently against the same node, defaults to {}'.format(VaultDetection.ENTRIES_PER_NODE), default=VaultDetection.ENTRIES_PER_NODE, type=int)
+    parser.add_argument('--all_pools', required=False, help='write {name}_pid{pid}.csv for every pool of each configured master-chef', action='store_true')
+    parser.add_argument('--code_fname', required=False, help='sqlite file keeping the code hash and size of checked addresses, defaults to {}'.format(CodeStore.CODE_FNAME), default=CodeStore.CODE_FNAME)
+    parser.add_argument('--async_rpc', required=False, help='send requests from an asyncio event loop (needs aiohttp)', action='store_true')
+    parser.add_argument('--max_in_flight', required=False, help='concurrent requests per node with --async_rpc, defaults to {}'.format(AsyncRPCBackend.MAX_IN_FLIGHT), default=AsyncRPCBackend.MAX_IN_FLIGHT, type=int)
+    parser.add_argument('--rate', required=False, help='max requests per second per node, unlimited by default', default=None, type=float)
+    parser.add_argument('--burst', required=False, help='requests per node that may be sent at once within --rate, defaults to 1', default=None, type=int)
+    parser.add_argument('--hedge', required=False, help='send requests slower than the p95 latency again to the next node of the pool', action='store_true')
+    parser.add_argument('--record', required=False, help='gzipped file to record every json-rpc call and response to, runs the entries one at a time with one scan worker', default=None)
+    parser.add_argument('--replay', required=False, help='answer json-rpc requests from a --record file instead of the nodes, runs the entries one at a time with one scan worker', default=None)
+    parser.add_argument('--replay_latency', required=False, help='replayed requests take this many times their recorded latency, defaults to 0',
+                        default=0.0, type=float)
     args = parser.parse_args()
 
-    vault_detection = VaultDetection(args.verbose, args.eth_node_url, args.bsc_node_url)
+    vault_detection = VaultDetection(args.verbose, args.eth_node_url, args.bsc_node_url, args.pool_size, args.n_workers, args.batch_size,
+                                     args.multicall, None if args.no_cache else args.cache_fname, args.state_fname, args.incremental, args.resume,
+                                     args.positions, args.at_block, args.snapshot_series, args.n_entries, args.entries_per_node,
+                                     args.all_pools, args.code_fname, args.async_rpc, args.max_in_flight,
+                                     args.rate, args.burst, args.hedge, args.record, args.replay, args.replay_latency)
     vault_detection.main()
@@ -0,0 +1,432 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from eth_abi import encode_abi, decode_abi
+from eth_utils import function_signature_to_4byte_selector, event_signature_to_log_topic, to_checksum_address, keccak
+from collections import Counter
+from array import array
+import threading
+import argparse
+import bisect
+import random
+import json
+import time
+
+from multicall import MULTICALL_ADDRESS
+from scheduler import TokenBucket
+
+
+def selector(signature):
+    return function_signature_to_4byte_selector(signature)
+
+
+def topic(signature):
+    return '0x' + event_signature_to_log_topic(signature).hex()
+
+
+def word(value):
+    return '0x{:064x}'.format(value)
+
+
+EVENTS = ['Deposit', 'Withdraw', 'EmergencyWithdraw']
+EVENT_TOPICS = [topic('{}(address,uint256,uint256)'.format(event)) for event in EVENTS]
+DEPOSIT, WITHDRAW, EMERGENCY_WITHDRAW = range(3)
+
+CONTRACT_CODE = '0x6080604052'
+PROXY_CODE = '0x60806040523661'
+
+# derived here rather than imported from vaults, so the mock checks the constants used there
+EIP1967_IMPLEMENTATION_SLOT = int.from_bytes(keccak(text='eip1967.proxy.implementation'), 'big') - 1
+
+
+class SyntheticChain(object):
+
+    def __init__(self, n_users=1000, n_logs=10000, n_pools=2, head_block=2000000, start_block=1000000, withdraw_ratio=0.3,
+                 emergency_ratio=0.01, contract_ratio=0.05, proxy_ratio=0.5, master_chef=None, lp_addresses=None, seed=1):
+
+        # a MasterChef with n_pools pools and n_logs Deposit/Withdraw/EmergencyWithdraw logs between start_block and
+        # head_block. lp_addresses: pid -> lp address, e.g. to match a config.json entry, other pools get made up addresses.
+        # proxy_ratio of the contract users are EIP-1967 proxies, alternately of a vault and of a plain implementation
+        rng = random.Random(seed)
+
+        self.head_block = head_block
+        self.start_block = start_block
+        self.master_chef = to_checksum_address(master_chef or '0x' + 'c0' * 20)
+        self.users = [to_checksum_address('0x{:040x}'.format(0x1000 + i)) for i in range(n_users)]
+        self.user_index = {user.lower(): i for i, user in enumerate(self.users)}
+        self.n_contracts = int(n_users * contract_ratio)
+        self.n_proxies = int(self.n_contracts * proxy_ratio)
+        self.implementations = [to_checksum_address('0x' + 'a1' * 20), to_checksum_address('0x' + 'a2' * 20)]
+
+        lp_addresses = {int(pid): address for pid, address in (lp_addresses or dict()).items()}
+        self.lp_addresses = [to_checksum_address(lp_addresses.get(pid, '0x{:040x}'.format(0x1a00 + pid))) for pid in range(n_pools)]
+        self.lp_pids = {address.lower(): pid for pid, address in enumerate(self.lp_addresses)}
+        self.ref_token = to_checksum_address('0x' + 'ee' * 20)
+        self.other_token = to_checksum_address('0x' + 'dd' * 20)
+
+        # logs of every pool sorted by block, as parallel arrays: block, log index, event, user index, amount
+        self.logs = dict()
+        # balance history per (pid, user index) and total staked history per pid, as (blocks, values)
+        self.balances = dict()
+        self.totals = dict()
+
+        blocks = sorted(rng.randint(start_block, head_block) for _ in range(n_logs))
+        pids = [rng.randrange(n_pools) for _ in range(n_logs)]
+
+        for pid in range(n_pools):
+            self.logs[pid] = tuple(array('q') for _ in range(5))
+            self.totals[pid] = ([start_block - 1], [0])
+
+        for log_index, (block, pid) in enumerate(zip(blocks, pids)):
+
+            user = rng.randrange(n_users)
+            blocks_history, balances_history = self.balances.setdefault((pid, user), ([], []))
+            balance = balances_history[-1] if balances_history else 0
+
+            r = rng.random()
+            if balance and r < emergency_ratio:
+                event, amount, new_balance = EMERGENCY_WITHDRAW, balance, 0
+            elif balance and r < emergency_ratio + withdraw_ratio:
+                amount = rng.randint(1, balance)
+                event, new_balance = WITHDRAW, balance - amount
+            else:
+                amount = rng.randint(10 ** 15, 10 ** 18)
+                event, new_balance = DEPOSIT, balance + amount
+
+            for column, value in zip(self.logs[pid], (block, log_index, event, user, amount)):
+                column.append(value)
+
+            blocks_history.append(block)
+            balances_history.append(new_balance)
+
+            total_blocks, total_values = self.totals[pid]
+            total_blocks.append(block)
+            total_values.append(total_values[-1] + new_balance - balance)
+
+        self.n_logs = n_logs
+
+    @staticmethod
+    def value_at(history, block):
+        blocks, values = history
+        i = bisect.bisect_right(blocks, block)
+        return values[i - 1] if i else 0
+
+    def user_amount(self, pid, user, block):
+        user = self.user_index.get(user.lower())
+        return 0 if user is None or (pid, user) not in self.balances else self.value_at(self.balances[(pid, user)], block)
+
+    def pool_total(self, pid, block):
+        return self.value_at(self.totals[pid], block)
+
+    def implementation(self, address):
+
+        # implementation of an EIP-1967 proxy user, None for any other address
+        user = self.user_index.get(address.lower())
+        return self.implementations[user % 2] if user is not None and user < self.n_proxies else None
+
+    def get_code(self, address):
+
+        address = address.lower()
+        if address in (self.master_chef.lower(), MULTICALL_ADDRESS.lower()) or address in self.lp_pids or \
+                address in [implementation.lower() for implementation in self.implementations]:
+            return CONTRACT_CODE
+        if self.implementation(address):
+            return PROXY_CODE
+
+        user = self.user_index.get(address)
+        return CONTRACT_CODE if user is not None and user < self.n_contracts else '0x'
+
+    def get_storage_at(self, address, slot):
+        implementation = self.implementation(address) if slot == EIP1967_IMPLEMENTATION_SLOT else None
+        return word(int(implementation, 16) if implementation else 0)
+
+    def get_logs(self, from_block, to_block, topics):
+
+        # topics: eth_getLogs topic filter on topic0 (events) and topic2 (pid), the user topic is not filtered
+        topics = list(topics or []) + [None] * 3
+        event_filter, user_filter, pid_filter = [t if t is None or isinstance(t, list) else [t] for t in topics[:3]]
+
+        events = None if event_filter is None else set(EVENT_TOPICS.index(t) for t in event_filter if t in EVENT_TOPICS)
+        pids = range(len(self.logs)) if pid_filter is None else [int(t, 16) for t in pid_filter if int(t, 16) in self.logs]
+        users = None if user_filter is None else set(self.user_index.get('0x' + t[-40:].lower(), -1) for t in user_filter)
+
+        matches = list()
+        for pid in pids:
+            blocks, log_indexes, log_events, log_users, amounts = self.logs[pid]
+            for i in range(bisect.bisect_left(blocks, from_block), bisect.bisect_right(blocks, to_block)):
+                if (events is None or log_events[i] in events) and (users is None or log_users[i] in users):
+                    matches.append((blocks[i], log_indexes[i], pid, i))
+
+        matches.sort()
+        return matches
+
+    def format_log(self, pid, i):
+
+        blocks, log_indexes, log_events, log_users, amounts = self.logs[pid]
+        return {'address': self.master_chef, 'blockNumber': hex(blocks[i]), 'blockHash': word(blocks[i]), 'logIndex': hex(log_indexes[i]),
+                'transactionHash': word(log_indexes[i]), 'transactionIndex': '0x0', 'removed': False, 'data': word(amounts[i]),
+                'topics': [EVENT_TOPICS[log_events[i]], '0x' + '0' * 24 + self.users[log_users[i]][2:].lower(), word(pid)]}
+
+    def call(self, to, data, block):
+
+        # the MasterChef, its lp pairs and Multicall3, by selector. reverts raise ValueError
+        function, args = data[:4], data[4:]
+        lp_pid = self.lp_pids.get(to.lower())
+
+        if function == selector('tryAggregate(bool,(address,bytes)[])'):
+            require_success, calls = decode_abi(['bool', '(address,bytes)[]'], args)
+            results = list()
+            for target, call_data in calls:
+                try:
+                    results.append((True, self.call(target, call_data, block)))
+                except ValueError:
+                    if require_success:
+                        raise
+                    results.append((False, b''))
+            return encode_abi(['(bool,bytes)[]'], [results])
+
+        if function == selector('userInfo(uint256,address)'):
+            pid, user = decode_abi(['uint256', 'address'], args)
+            return encode_abi(['uint256', 'uint256'], [self.user_amount(pid, user, block), 0])
+        if function == selector('poolInfo(uint256)'):
+            pid, = decode_abi(['uint256'], args)
+            if pid >= len(self.lp_addresses):
+                raise ValueError('execution reverted')
+            return encode_abi(['address', 'uint256', 'uint256', 'uint256'], [self.lp_addresses[pid], 100, self.start_block, 0])
+        if function == selector('poolLength()'):
+            return encode_abi(['uint256'], [len(self.lp_addresses)])
+
+        # proxies of the vault implementation answer pricePerShare, every other probe reverts
+        if function == selector('pricePerShare()') and self.implementation(to) == self.implementations[0]:
+            return encode_abi(['uint256'], [10 ** 18])
+
+        if lp_pid is not None:
+            if function == selector('balanceOf(address)'):
+                owner, = decode_abi(['address'], args)
+                return encode_abi(['uint256'], [self.pool_total(lp_pid, block) if owner.lower() == self.master_chef.lower() else 0])
+            if function == selector('totalSupply()'):
+                return encode_abi(['uint256'], [2 * self.pool_total(lp_pid, block) + 10 ** 18])
+            if function == selector('getReserves()'):
+                return encode_abi(['uint112', 'uint112', 'uint32'], [10 ** 24, 10 ** 24, 0])
+            if function in (selector('token0()'), selector('token1()')):
+                return encode_abi(['address'], [self.ref_token if function == selector('token0()') else self.other_token])
+
+        raise ValueError('execution reverted')
+
+
+class MockNode(object):
+
+    def __init__(self, chain, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, max_block_range=None, max_results=10000, max_batch_size=None,
+                 rate_limit=None, error_rate=0.0, stall_rate=0.0, stall=0.0, seed=1):
+
+        # a json-rpc node serving chain. latency (+ up to jitter) seconds per http request, eth_getLogs ranges above
+        # max_block_range blocks or with more than max_results logs fail like on hosted nodes, requests above rate_limit
+        # per second get http 429 and error_rate of the requests get a -32005 rate limit error. stall_rate of the http
+        # requests take stall seconds longer, like the slow tail of a hosted node
+        self.chain = chain
+        self.latency = latency
+        self.jitter = jitter
+        self.max_block_range = max_block_range
+        self.max_results = max_results
+        self.max_batch_size = max_batch_size
+        self.error_rate = error_rate
+        self.stall_rate = stall_rate
+        self.stall = stall
+        self.bucket = TokenBucket(rate_limit, max(int(rate_limit or 1), 1)) if rate_limit else None
+
+        self.stats = Counter()
+        self.filters = dict()
+        self.filter_count = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                status, body = node.handle(self.rfile.read(int(self.headers['Content-Length'])))
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, body):
+
+        with self._lock:
+            self.stats['http_requests'] += 1
+            throttled = self.bucket is not None and not self.bucket.try_acquire()
+            failing = self._rng.random() < self.error_rate
+            delay = self.latency + self._rng.random() * self.jitter
+            if self._rng.random() < self.stall_rate:
+                self.stats['http_stalled'] += 1
+                delay += self.stall
+
+        if delay:
+            time.sleep(delay)
+
+        if throttled:
+            with self._lock:
+                self.stats['http_429'] += 1
+            return 429, b''
+
+        request = json.loads(body)
+        calls = request if isinstance(request, list) else [request]
+
+        if self.max_batch_size is not None and len(calls) > self.max_batch_size:
+            return 200, json.dumps({'jsonrpc': '2.0', 'id': None, 'error': {'code': -32600, 'message': 'batch too large'}}).encode()
+
+        responses = [self.handle_call(call, failing) for call in calls]
+        return 200, json.dumps(responses if isinstance(request, list) else responses[0]).encode()
+
+    def handle_call(self, call, failing=False):
+
+        with self._lock:
+            self.stats[call['method']] += 1
+
+        if failing:
+            return {'jsonrpc': '2.0', 'id': call.get('id'), 'error': {'code': -32005, 'message': 'request rate limited'}}
+
+        try:
+            return {'jsonrpc': '2.0', 'id': call.get('id'), 'result': self.dispatch(call['method'], call.get('params') or [])}
+        except ValueError as e:
+            error = e.args[0] if isinstance(e.args[0], dict) else {'code': -32000, 'message': str(e)}
+            return {'jsonrpc': '2.0', 'id': call.get('id'), 'error': error}
+
+    def block_number(self, block):
+
+        if block in (None, 'latest', 'pending', 'safe', 'finalized'):
+            return self.chain.head_block
+        if block == 'earliest':
+            return 0
+        return min(int(block, 16) if isinstance(block, str) else block, self.chain.head_block)
+
+    def get_logs(self, log_filter):
+
+        from_block = self.block_number(log_filter.get('fromBlock'))
+        to_block = self.block_number(log_filter.get('toBlock'))
+
+        if self.max_block_range is not None and to_block - from_block + 1 > self.max_block_range:
+            raise ValueError({'code': -32005, 'message': 'block range too large, max {}'.format(self.max_block_range)})
+
+        # address is a single address or a list of them, web3's createFilter always sends a list
+        addresses = log_filter.get('address')
+        if addresses and self.chain.master_chef.lower() not in [str(address).lower() for address in
+                                                                 (addresses if isinstance(addresses, list) else [addresses])]:
+            return list()
+
+        matches = self.chain.get_logs(from_block, to_block, log_filter.get('topics'))
+        if self.max_results is not None and len(matches) > self.max_results:
+            raise ValueError({'code': -32005, 'message': 'query returned more than {} results'.format(self.max_results)})
+
+        return [self.chain.format_log(pid, i) for block, log_index, pid, i in matches]
+
+    def dispatch(self, method, params):
+
+        if method == 'eth_blockNumber':
+            return hex(self.chain.head_block)
+        if method in ('eth_chainId', 'net_version'):
+            return '0x539' if method == 'eth_chainId' else '1337'
+        if method == 'web3_clientVersion':
+            return 'vault_detection/mock_node'
+
+        if method == 'eth_getLogs':
+            return self.get_logs(params[0])
+
+        if method == 'eth_newFilter':
+            with self._lock:
+                # ids are never reused, so an uninstalled filter's id cannot point at a newer filter
+                self.filter_count += 1
+                filter_id = hex(self.filter_count)
+                self.filters[filter_id] = params[0]
+            return filter_id
+        if method == 'eth_getFilterLogs':
+            if params[0] not in self.filters:
+                raise ValueError({'code': -32000, 'message': 'filter not found'})
+            return self.get_logs(self.filters[params[0]])
+        if method == 'eth_uninstallFilter':
+            with self._lock:
+                return self.filters.pop(params[0], None) is not None
+
+        if method == 'eth_getCode':
+            return self.chain.get_code(params[0])
+        if method == 'eth_getStorageAt':
+            # like geth, storage keys longer than 32 bytes are rejected
+            if len(params[1]) != 66:
+                raise ValueError({'code': -32602, 'message': 'invalid argument 1: hex string has length {}, want 64 for common.Hash'.format(len(params[1]) - 2)})
+            return self.chain.get_storage_at(params[0], int(params[1], 16))
+        if method == 'eth_call':
+            call = params[0]
+            data = bytes.fromhex(call.get('data', call.get('input', '0x'))[2:])
+            return '0x' + self.chain.call(call['to'], data, self.block_number(params[1] if len(params) > 1 else None)).hex()
+
+        raise ValueError({'code': -32601, 'message': 'the method {} does not exist'.format(method)})
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', required=False, help='defaults to 8545', default=8545, type=int)
+    parser.add_argument('--config_entry', required=False, help='name of a config.json entry whose master-chef and lp addresses the chain uses', default=None)
+    parser.add_argument('--n_users', required=False, help='defaults to 1000', default=1000, type=int)
+    parser.add_argument('--n_logs', required=False, help='Deposit/Withdraw/EmergencyWithdraw logs, defaults to 10000', default=10000, type=int)
+    parser.add_argument('--n_pools', required=False, help='defaults to 2', default=2, type=int)
+    parser.add_argument('--head_block', required=False, help='defaults to 2000000', default=2000000, type=int)
+    parser.add_argument('--start_block', required=False, help='first block with logs, defaults to 1000000', default=1000000, type=int)
+    parser.add_argument('--contract_ratio', required=False, help='share of users with code, defaults to 0.05', default=0.05, type=float)
+    parser.add_argument('--proxy_ratio', required=False, help='share of the contract users that are EIP-1967 proxies, defaults to 0.5', default=0.5, type=float)
+    parser.add_argument('--latency', required=False, help='seconds per http request, defaults to 0', default=0.0, type=float)
+    parser.add_argument('--jitter', required=False, help='up to this many more seconds per http request, defaults to 0', default=0.0, type=float)
+    parser.add_argument('--max_block_range', required=False, help='eth_getLogs range limit, unlimited by default', default=None, type=int)
+    parser.add_argument('--max_results', required=False, help='eth_getLogs result limit, defaults to 10000', default=10000, type=int)
+    parser.add_argument('--max_batch_size', required=False, help='json-rpc batch limit, unlimited by default', default=None, type=int)
+    parser.add_argument('--rate_limit', required=False, help='http requests per second above which 429 is returned, unlimited by default', default=None, type=float)
+    parser.add_argument('--error_rate', required=False, help='share of requests failing with a -32005 rate limit error, defaults to 0', default=0.0, type=float)
+    parser.add_argument('--stall_rate', required=False, help='share of http requests that stall, defaults to 0', default=0.0, type=float)
+    parser.add_argument('--stall', required=False, help='seconds a stalled http request takes longer, defaults to 0', default=0.0, type=float)
+    args = parser.parse_args()
+
+    master_chef, lp_addresses = None, None
+    if args.config_entry:
+        with open('config.json') as f:
+            contract_info = [info for info in json.load(f) if info['name'] == args.config_entry][0]
+        master_chef, lp_addresses = contract_info['address'], {contract_info['pid']: contract_info['lp']['address']}
+        args.n_pools = max(args.n_pools, contract_info['pid'] + 1)
+
+    print('generating {} logs of {} users...'.format(args.n_logs, args.n_users))
+    chain = SyntheticChain(args.n_users, args.n_logs, args.n_pools, args.head_block, args.start_block, contract_ratio=args.contract_ratio,
+                           proxy_ratio=args.proxy_ratio, master_chef=master_chef, lp_addresses=lp_addresses)
+
+    mock_node = MockNode(chain, port=args.port, latency=args.latency, jitter=args.jitter, max_block_range=args.max_block_range,
+                         max_results=args.max_results, max_batch_size=args.max_batch_size, rate_limit=args.rate_limit, error_rate=args.error_rate,
+                         stall_rate=args.stall_rate, stall=args.stall)
+    print('serving {} (master-chef {})'.format(mock_node.url, chain.master_chef))
+
+    try:
+        mock_node.server.serve_forever()
+    except KeyboardInterrupt:
+        print(dict(mock_node.stats))
@@ -0,0 +1,59 @@
+from web3 import Web3
+
+# Multicall3 is deployed at the same address on eth and bsc
+MULTICALL_ADDRESS = '0xcA11bde05977b3631167028862bE2a173976CA11'
+
+MULTICALL_ABI = [
+    {'inputs': [{'internalType': 'bool', 'name': 'requireSuccess', 'type': 'bool'},
+                {'components': [{'internalType': 'address', 'name': 'target', 'type': 'address'},
+                                {'internalType': 'bytes', 'name': 'callData', 'type': 'bytes'}],
+                 'internalType': 'struct Multicall3.Call[]', 'name': 'calls', 'type': 'tuple[]'}],
+     'name': 'tryAggregate',
+     'outputs': [{'components': [{'internalType': 'bool', 'name': 'success', 'type': 'bool'},
+                                 {'internalType': 'bytes', 'name': 'returnData', 'type': 'bytes'}],
+                  'internalType': 'struct Multicall3.Result[]', 'name': 'returnData', 'type': 'tuple[]'}],
+     'stateMutability': 'payable', 'type': 'function'},
+]
+
+
+class Multicall(object):
+
+    CALLS_PER_AGGREGATE = 500
+
+    def __init__(self, batch_caller, address=MULTICALL_ADDRESS, calls_per_aggregate=CALLS_PER_AGGREGATE):
+
+        # aggregated calls are themselves sent through the batch caller, so several aggregates share one json-rpc batch
+        self.batch_caller = batch_caller
+        self.calls_per_aggregate = max(calls_per_aggregate, 1)
+        self.contract = batch_caller.w3.eth.contract(address=Web3.toChecksumAddress(address), abi=MULTICALL_ABI)
+
+    def call_functions(self, functions, block_identifier='latest', progress=None, allow_failure=False):
+
+        # same interface as BatchCaller.call_functions
+        groups = [functions[i:i + self.calls_per_aggregate] for i in range(0, len(functions), self.calls_per_aggregate)]
+        aggregates = [self.contract.functions.tryAggregate(False, [(function.address, function._encode_transaction_data()) for function in group])
+                      for group in groups]
+
+        remaining = [len(functions)]
+
+        def aggregate_progress(n):
+            n_calls = min(n * self.calls_per_aggregate, remaining[0])
+            remaining[0] -= n_calls
+            progress(n_calls)
+
+        results = self.batch_caller.call_functions(aggregates, block_identifier, progress=aggregate_progress if progress else None)
+
+        outputs = list()
+        for group, group_results in zip(groups, results):
+            for function, (success, return_data) in zip(group, group_results):
+
+                if allow_failure:
+                    outputs.append(self.batch_caller.try_decode_output(function, return_data) if success else None)
+                    continue
+
+                if not success:
+                    raise ValueError('multicall: {} reverted at {}'.format(function.fn_name, function.address))
+
+                outputs.append(self.batch_caller.decode_output(function, return_data))
+
+        return outputs
@@ -0,0 +1,291 @@
+from web3.providers.base import JSONBaseProvider
+from requests.exceptions import ConnectionError as RequestsConnectionError
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
+import threading
+import asyncio
+import random
+import time
+
+try:
+    from aiohttp import ClientConnectionError
+except ImportError:
+    ClientConnectionError = ConnectionError
+
+from scheduler import classify_error, http_status, RATE_LIMITED, SIZE, TIMEOUT
+
+
+class NodeHealth(object):
+
+    # weight of the newest observation in the moving averages
+    ALPHA = 0.2
+    # latency assumed for a node without observations
+    DEFAULT_LATENCY = 0.2
+
+    def __init__(self):
+
+        self.latency = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.in_flight = 0
+        self.ejected_until = 0
+
+    def score(self):
+        # lower is better: slow, busy and failing nodes get a smaller share of the requests
+        latency = self.DEFAULT_LATENCY if self.latency is None else self.latency
+        return latency * (1 + self.in_flight) * (1 + 4 * self.error_rate)
+
+    def success(self, latency):
+
+        self.latency = latency if self.latency is None else (1 - self.ALPHA) * self.latency + self.ALPHA * latency
+        self.error_rate *= 1 - self.ALPHA
+        self.failures = 0
+
+    def failure(self):
+
+        self.error_rate = (1 - self.ALPHA) * self.error_rate + self.ALPHA
+        self.failures += 1
+
+
+class NodePool(JSONBaseProvider):
+
+    # consecutive failures after which a node is left out for EJECT_TIME seconds
+    EJECT_AFTER = 3
+    EJECT_TIME = 30
+    # a hedge is sent once a request takes longer than this percentile of the last HEDGE_WINDOW latencies of its kind
+    HEDGE_PERCENTILE = 95
+    HEDGE_WINDOW = 200
+    HEDGE_MIN_SAMPLES = 20
+    HEDGE_WORKERS = 64
+
+    def __init__(self, providers, verbose=0, hedge=False):
+
+        # providers: one PooledHTTPProvider or AsyncHTTPProvider per endpoint of the same chain
+        super().__init__()
+        self.providers = providers
+        self.endpoint_uri = ','.join(provider.endpoint_uri for provider in providers)
+        self.verbose = verbose
+        self.hedge = hedge
+
+        self.health = {provider.endpoint_uri: NodeHealth() for provider in providers}
+        self.latencies = dict()
+        self.hedges = self.hedge_wins = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.HEDGE_WORKERS) if hedge else None
+
+    def ranked(self):
+
+        # healthy nodes in a random order weighted by their score, so concurrent requests spread over the pool
+        # in proportion to how fast the nodes answer, then the ejected nodes in the order they come back
+        now = time.monotonic()
+        with self._lock:
+            healthy = [(random.random() ** self.health[provider.endpoint_uri].score(), provider) for provider in self.providers
+                       if self.health[provider.endpoint_uri].ejected_until <= now]
+            ejected = [(self.health[provider.endpoint_uri].ejected_until, provider) for provider in self.providers
+                       if self.health[provider.endpoint_uri].ejected_until > now]
+
+        return [provider for key, provider in sorted(healthy, key=lambda x: x[0], reverse=True)] + \
+               [provider for key, provider in sorted(ejected, key=lambda x: x[0])]
+
+    def started(self, provider):
+
+        with self._lock:
+            self.health[provider.endpoint_uri].in_flight += 1
+        return time.monotonic()
+
+    def finished(self, provider, start, ok, kind=None):
+
+        # ok None: the request failed for its own sake, e.g. a too large eth_getLogs, which says nothing about the node
+        with self._lock:
+
+            health = self.health[provider.endpoint_uri]
+            health.in_flight -= 1
+
+            if ok is None:
+                return
+
+            if ok:
+                health.success(time.monotonic() - start)
+                self.latencies.setdefault(kind, deque(maxlen=self.HEDGE_WINDOW)).append(time.monotonic() - start)
+                return
+
+            health.failure()
+            if health.failures >= self.EJECT_AFTER:
+                health.ejected_until = time.monotonic() + self.EJECT_TIME
+                health.failures = 0
+                if self.verbose >= 1:
+                    print('{} ejected for {}s'.format(provider.endpoint_uri, self.EJECT_TIME))
+
+    @staticmethod
+    def is_throttled(response):
+
+        # a single response, or a batch of which every call, still throttled after the node's own retries
+        responses = response if isinstance(response, list) else [response]
+        return bool(responses) and all(isinstance(r, dict) and 'error' in r and classify_error(ValueError(r['error'])) == RATE_LIMITED
+                                       for r in responses)
+
+    @staticmethod
+    def is_node_failure(e):
+
+        # connection errors, 5xx answers and throttling are failed over. timeouts and size errors are the request's own:
+        # the next node would fail the same way, so they go straight back to the caller, e.g. for the scanner to shrink its chunks
+        if isinstance(e, (RequestsConnectionError, ClientConnectionError, ConnectionError)):
+            return True
+        error_class = classify_error(e)
+        if error_class in (SIZE, TIMEOUT):
+            return False
+        status = http_status(e)
+        return error_class == RATE_LIMITED or (isinstance(status, int) and status >= 500)
+
+    def hedge_delay(self, kind):
+
+        # None until enough latencies of this kind of request were observed
+        with self._lock:
+            latencies = sorted(self.latencies.get(kind, ()))
+
+        if len(latencies) < self.HEDGE_MIN_SAMPLES:
+            return None
+        return latencies[min(len(latencies) - 1, len(latencies) * self.HEDGE_PERCENTILE // 100)]
+
+    @staticmethod
+    def request_kind(method, calls=None):
+        # requests are hedged against the latencies of the same method, batches separately from single calls
+        return method if calls is None else 'batch:{}'.format(calls[0][0] if calls else '')
+
+    def hedged(self, send, kind):
+
+        # a request still running after hedge_delay is sent again starting from the next node, the first answer wins
+        # and the slower request is left to finish in the background
+        providers = self.ranked()
+        delay = self.hedge_delay(kind) if self.hedge else None
+        if delay is None:
+            return self.failover(send, kind, providers)
+
+        primary = self._executor.submit(self.failover, send, kind, providers)
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+
+        with self._lock:
+            self.hedges += 1
+        hedge = self._executor.submit(self.failover, send, kind, providers[1:] + providers[:1])
+        if self.verbose >= 2:
+            print('{} request not answered after {:.2f}s, hedging'.format(kind, delay))
+
+        pending = {primary, hedge}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            succeeded = [future for future in done if future.exception() is None]
+            if succeeded or not pending:
+                future = (succeeded or list(done))[0]
+                if future is hedge:
+                    with self._lock:
+                        self.hedge_wins += 1
+                return future.result()
+
+    def failover(self, send, kind=None, providers=None):
+
+        # send(provider) is tried on the nodes in ranked order until one answers. node failures (connection errors,
+        # 5xx, throttling) move on to the next node, json-rpc errors of the request itself are returned and its
+        # timeouts or other errors are raised
+        providers = self.ranked() if providers is None else providers
+        for i, provider in enumerate(providers):
+
+            start = self.started(provider)
+            try:
+                response = send(provider)
+            except Exception as e:
+                node_failure = self.is_node_failure(e)
+                self.finished(provider, start, False if node_failure else None)
+                if not node_failure or i == len(providers) - 1:
+                    raise
+                if self.verbose >= 2:
+                    print('{} failed ({!r}), failing over'.format(provider.endpoint_uri, e))
+                continue
+
+            throttled = self.is_throttled(response)
+            self.finished(provider, start, not throttled, kind)
+            if not throttled or i == len(providers) - 1:
+                return response
+
+    def make_request(self, method, params):
+        return self.hedged(lambda provider: provider.make_request(method, params), self.request_kind(method))
+
+    def make_batch_request(self, calls):
+        return self.hedged(lambda provider: provider.make_batch_request(calls), self.request_kind(None, calls))
+
+
+class AsyncNodePool(NodePool):
+
+    def __init__(self, providers, verbose=0, hedge=False):
+
+        # a pool of AsyncHTTPProvider, requests fail over and are hedged on the backend's event loop
+        super().__init__(providers, verbose, hedge=False)
+        self.hedge = hedge
+        self.backend = providers[0].backend
+
+    @property
+    def max_pending(self):
+        return sum(provider.max_pending for provider in self.providers)
+
+    async def async_hedged(self, send, kind):
+
+        # same as hedged for a coroutine function send
+        providers = self.ranked()
+        delay = self.hedge_delay(kind) if self.hedge else None
+        if delay is None:
+            return await self.async_failover(send, kind, providers)
+
+        primary = asyncio.ensure_future(self.async_failover(send, kind, providers))
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result()
+
+        with self._lock:
+            self.hedges += 1
+        hedge = asyncio.ensure_future(self.async_failover(send, kind, providers[1:] + providers[:1]))
+        if self.verbose >= 2:
+            print('{} request not answered after {:.2f}s, hedging'.format(kind, delay))
+
+        pending = {primary, hedge}
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            succeeded = [future for future in done if future.exception() is None]
+            if succeeded or not pending:
+                future = (succeeded or list(done))[0]
+                if future is hedge:
+                    with self._lock:
+                        self.hedge_wins += 1
+                return future.result()
+
+    async def async_failover(self, send, kind=None, providers=None):
+
+        # same as failover for a coroutine function send
+        providers = self.ranked() if providers is None else providers
+        for i, provider in enumerate(providers):
+
+            start = self.started(provider)
+            try:
+                response = await send(provider)
+            except Exception as e:
+                node_failure = self.is_node_failure(e)
+                self.finished(provider, start, False if node_failure else None)
+                if not node_failure or i == len(providers) - 1:
+                    raise
+                if self.verbose >= 2:
+                    print('{} failed ({!r}), failing over'.format(provider.endpoint_uri, e))
+                continue
+
+            throttled = self.is_throttled(response)
+            self.finished(provider, start, not throttled, kind)
+            if not throttled or i == len(providers) - 1:
+                return response
+
+    def make_request(self, method, params):
+        return self.backend.run(self.async_hedged(lambda provider: provider.request(method, params), self.request_kind(method)))
+
+    def make_batch_request(self, calls):
+        return self.backend.run(self.async_hedged(lambda provider: provider.batch_request(calls), self.request_kind(None, calls)))
+
+    def submit_batch_request(self, calls):
+        return self.backend.submit(self.async_hedged(lambda provider: provider.batch_request(calls), self.request_kind(None, calls)))
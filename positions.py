@@ -0,0 +1,50 @@
+import bisect
+
+
+POSITION_EVENTS = ['Deposit', 'Withdraw', 'EmergencyWithdraw']
+
+
+class PositionTracker(object):
+
+    def __init__(self, balances=None):
+
+        # user -> net staked amount, built only from MasterChef events
+        self.balances = dict() if balances is None else balances
+
+    def apply(self, entry):
+
+        # deposits add and withdrawals subtract, EmergencyWithdraw carries the whole staked amount. Being plain sums,
+        # entries can be applied in any order, e.g. chunk by chunk from the newest block backwards
+        if entry.event == 'Deposit':
+            self.balances[entry.user] = self.balances.get(entry.user, 0) + entry.amount
+        elif entry.event in ('Withdraw', 'EmergencyWithdraw'):
+            self.balances[entry.user] = self.balances.get(entry.user, 0) - entry.amount
+        else:
+            raise TypeError('unsupported position event {}'.format(entry.event))
+
+
+class PositionSeries(object):
+
+    def __init__(self, target_blocks):
+
+        # net amount changes per user between consecutive target blocks, so one pass over the logs in any order
+        # gives the balances at every target: entry i covers (target_blocks[i - 1], target_blocks[i]]
+        self.target_blocks = sorted(set(target_blocks))
+        self.deltas = [PositionTracker() for _ in self.target_blocks]
+
+    def apply(self, entry):
+
+        i = bisect.bisect_left(self.target_blocks, entry.block_number)
+        if i < len(self.target_blocks):
+            self.deltas[i].apply(entry)
+
+    def snapshots(self):
+
+        # yields (target block, {user: amount}) from the oldest target to the newest
+        balances = dict()
+        for target_block, delta in zip(self.target_blocks, self.deltas):
+
+            for user, amount in delta.balances.items():
+                balances[user] = balances.get(user, 0) + amount
+
+            yield target_block, dict(balances)
@@ -0,0 +1,325 @@
+from web3 import Web3
+from web3.providers.rpc import HTTPProvider
+from web3._utils.abi import get_abi_output_types, map_abi_data
+from web3._utils.normalizers import BASE_RETURN_NORMALIZERS
+from eth_abi.exceptions import DecodingError
+from eth_utils import to_bytes
+from hexbytes import HexBytes
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+import requests
+from collections import deque
+import threading
+import json
+import time
+
+from scheduler import RequestScheduler, backoff_delay
+
+
+def make_session(pool_size):
+
+    # one keep-alive session per node, sized so concurrent callers never open throw-away connections
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def encode_batch_request(calls, request_counter):
+
+    # calls: list of (method, params), returns the json-rpc calls and the encoded batch
+    rpc_calls = [{'jsonrpc': '2.0', 'method': method, 'params': params or [], 'id': next(request_counter)}
+                 for method, params in calls]
+
+    return rpc_calls, to_bytes(text=json.dumps(rpc_calls))
+
+
+def match_batch_responses(rpc_calls, responses):
+
+    # some nodes answer a rejected batch with a single error object
+    if isinstance(responses, dict):
+        raise ValueError(responses.get('error', responses))
+
+    responses = {response.get('id'): response for response in responses}
+    return [responses.get(rpc_call['id'], {'error': {'code': -32603, 'message': 'missing response in batch'}})
+            for rpc_call in rpc_calls]
+
+
+class PooledHTTPProvider(HTTPProvider):
+
+    TIMEOUT = 30
+
+    def __init__(self, endpoint_uri, session, request_kwargs=None, scheduler=None, cassette=None, channel=None):
+
+        # with a cassette (cassette.Cassette) requests are recorded, or replayed without network, under channel
+        super().__init__(endpoint_uri, request_kwargs)
+        self.session = session
+        self.scheduler = scheduler or RequestScheduler()
+        self.cassette = cassette
+        self.channel = channel
+
+    def send(self, request_data):
+
+        request_kwargs = self.get_request_kwargs()
+        request_kwargs.setdefault('timeout', self.TIMEOUT)
+
+        response = self.session.post(self.endpoint_uri, data=request_data, **request_kwargs)
+        response.raise_for_status()
+
+        return self.decode_rpc_response(response.content)
+
+    def exchange(self, request_data):
+
+        if self.cassette is not None:
+            return self.cassette.call(self.channel, request_data, lambda: self.send(request_data))
+        return self.send(request_data)
+
+    def post(self, request_data):
+        # every request waits for the node's token bucket, throttled requests are retried with backoff
+        return self.scheduler.call(self.endpoint_uri, lambda: self.exchange(request_data))
+
+    def make_request(self, method, params):
+        return self.post(self.encode_rpc_request(method, params))
+
+    def make_batch_request(self, calls):
+
+        # calls: list of (method, params), responses are returned in the same order
+        rpc_calls, request_data = encode_batch_request(calls, self.request_counter)
+        return match_batch_responses(rpc_calls, self.post(request_data))
+
+
+class ClientRegistry(object):
+
+    POOL_SIZE = 16
+
+    def __init__(self, node_urls, pool_size=POOL_SIZE, async_backend=None, scheduler=None, hedge=False, cassette=None, verbose=0):
+
+        # node_urls: blockchain name -> node url, or several comma separated urls which are then used as one node pool.
+        # with an async_backend (async_rpc.AsyncRPCBackend) requests are sent from its event loop instead of the calling
+        # threads. the scheduler rate limits every node, with hedge slow requests are also sent to the next node of the pool.
+        # a cassette records the requests of every node, or replays them instead of sending
+        self.node_urls = {blockchain.lower(): [url.strip() for url in (urls.split(',') if isinstance(urls, str) else urls) if url.strip()]
+                          for blockchain, urls in node_urls.items()}
+        self.pool_size = pool_size
+        self.async_backend = async_backend
+        self.scheduler = scheduler or RequestScheduler()
+        self.hedge = hedge
+        self.cassette = cassette
+        self.verbose = verbose
+
+        self._lock = threading.Lock()
+        self._sessions = dict()
+        self._clients = dict()
+        self._contracts = dict()
+
+    def endpoints(self, blockchain):
+
+        blockchain = blockchain.lower()
+        if blockchain not in self.node_urls:
+            raise TypeError('unsupported blockchain {}'.format(blockchain))
+
+        return self.node_urls[blockchain]
+
+    def node_url(self, blockchain):
+        # identifies the chain's node (or node pool), e.g. for per-node limits
+        return ','.join(self.endpoints(blockchain))
+
+    def session(self, node_url):
+
+        with self._lock:
+            if node_url not in self._sessions:
+                self._sessions[node_url] = make_session(self.pool_size)
+            return self._sessions[node_url]
+
+    def provider(self, node_url, blockchain=None):
+
+        # recorded requests are keyed by blockchain rather than url, so a replay works with any node urls
+        if self.async_backend is not None:
+            from async_rpc import AsyncHTTPProvider
+            return AsyncHTTPProvider(node_url, self.async_backend, self.scheduler, self.cassette, blockchain)
+
+        return PooledHTTPProvider(node_url, self.session(node_url), scheduler=self.scheduler, cassette=self.cassette, channel=blockchain)
+
+    def w3(self, blockchain):
+
+        endpoints = self.endpoints(blockchain)
+        node_url = self.node_url(blockchain)
+        providers = [self.provider(endpoint, blockchain.lower()) for endpoint in endpoints] if node_url not in self._clients else None
+
+        with self._lock:
+            if node_url not in self._clients:
+                if len(providers) == 1 and not self.hedge:
+                    self._clients[node_url] = Web3(providers[0])
+                else:
+                    from node_pool import NodePool, AsyncNodePool
+                    node_pool = AsyncNodePool if self.async_backend is not None else NodePool
+                    self._clients[node_url] = Web3(node_pool(providers, verbose=self.verbose, hedge=self.hedge))
+            return self._clients[node_url]
+
+    def contract(self, blockchain, address, abi):
+
+        w3 = self.w3(blockchain)
+        address = Web3.toChecksumAddress(address)
+        key = (self.node_url(blockchain), address)
+
+        with self._lock:
+            if key not in self._contracts:
+                self._contracts[key] = w3.eth.contract(address=address, abi=abi)
+            return self._contracts[key]
+
+    def close(self):
+
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+
+            self._sessions.clear()
+            self._clients.clear()
+            self._contracts.clear()
+
+        if self.async_backend is not None:
+            self.async_backend.close()
+        if self.cassette is not None:
+            self.cassette.close()
+
+
+class BatchCaller(object):
+
+    BATCH_SIZE = 200
+    MAX_RETRIES = 3
+    RETRY_DELAY = 1
+
+    def __init__(self, w3, batch_size=BATCH_SIZE, n_workers=1, max_retries=MAX_RETRIES, verbose=0):
+
+        self.w3 = w3
+        self.batch_size = max(batch_size, 1)
+        self.n_workers = max(n_workers, 1)
+        self.max_retries = max_retries
+        self.verbose = verbose
+
+    def send_batch(self, calls):
+
+        try:
+            return self.w3.provider.make_batch_request(calls)
+        except Exception as e:
+            if self.verbose >= 2:
+                print(e)
+            return [{'error': e}] * len(calls)
+
+    @staticmethod
+    def is_revert(error):
+        return isinstance(error, dict) and (error.get('code') == 3 or 'revert' in str(error.get('message', '')).lower())
+
+    def submitted_batches(self, batches):
+
+        # with the async backend batches are submitted to its event loop, at most max_pending at a time, instead of
+        # being sent from n_workers threads. responses are yielded in the order of the batches
+        provider = self.w3.provider
+        pending = deque()
+        batches = iter(batches)
+
+        while True:
+
+            while len(pending) < provider.max_pending:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                pending.append((len(batch), provider.submit_batch_request(batch)))
+
+            if not pending:
+                return
+
+            n_calls, future = pending.popleft()
+            try:
+                yield future.result()
+            except Exception as e:
+                if self.verbose >= 2:
+                    print(e)
+                yield [{'error': e}] * n_calls
+
+    def request(self, calls, progress=None, allow_failure=False):
+
+        # calls: list of (method, params), returns the list of results in the same order.
+        # only the items that failed are sent again, up to max_retries times. with allow_failure
+        # reverted calls are not retried and their result is None
+        results = [None] * len(calls)
+        errors = dict()
+        pending = list(range(len(calls)))
+
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+
+            for attempt in range(self.max_retries + 1):
+
+                if attempt:
+                    time.sleep(backoff_delay(attempt, self.RETRY_DELAY))
+
+                batches = [pending[i:i + self.batch_size] for i in range(0, len(pending), self.batch_size)]
+                failed = list()
+
+                if hasattr(self.w3.provider, 'submit_batch_request'):
+                    batch_responses = self.submitted_batches([calls[i] for i in b] for b in batches)
+                else:
+                    batch_responses = executor.map(lambda b: self.send_batch([calls[i] for i in b]), batches)
+
+                for batch, responses in zip(batches, batch_responses):
+
+                    n_done = 0
+                    for i, response in zip(batch, responses):
+                        if 'error' in response and allow_failure and self.is_revert(response['error']):
+                            n_done += 1
+                        elif 'error' in response:
+                            errors[i] = response['error']
+                            failed.append(i)
+                        else:
+                            results[i] = response['result']
+                            n_done += 1
+
+                    if progress is not None:
+                        progress(n_done)
+
+                pending = failed
+                if not pending:
+                    break
+
+                if self.verbose >= 2:
+                    print('retrying {} failed calls ({})'.format(len(pending), errors[pending[0]]))
+
+        if pending:
+            error = errors[pending[0]]
+            raise error if isinstance(error, Exception) else ValueError(error)
+
+        return results
+
+    @staticmethod
+    def block_param(block_identifier):
+        return Web3.toHex(block_identifier) if isinstance(block_identifier, int) else block_identifier
+
+    def decode_output(self, function, return_data):
+
+        output_types = get_abi_output_types(function.abi)
+        output_data = self.w3.codec.decode_abi(output_types, HexBytes(return_data))
+        normalized_data = map_abi_data(BASE_RETURN_NORMALIZERS, output_types, output_data)
+
+        return normalized_data[0] if len(normalized_data) == 1 else normalized_data
+
+    def try_decode_output(self, function, return_data):
+
+        # None for reverted calls and calls to accounts without code
+        if return_data is None:
+            return None
+
+        try:
+            return self.decode_output(function, return_data)
+        except DecodingError:
+            return None
+
+    def call_functions(self, functions, block_identifier='latest', progress=None, allow_failure=False):
+
+        # functions: bound contract functions, e.g. contract.functions.userInfo(pid, addr)
+        calls = [('eth_call', [{'to': function.address, 'data': function._encode_transaction_data()}, self.block_param(block_identifier)])
+                 for function in functions]
+
+        decode_output = self.try_decode_output if allow_failure else self.decode_output
+        return [decode_output(function, return_data)
+                for function, return_data in zip(functions, self.request(calls, progress=progress, allow_failure=allow_failure))]
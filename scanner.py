@@ -0,0 +1,277 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import threading
+from collections import deque, namedtuple
+from functools import lru_cache
+from eth_abi import encode_single
+from eth_utils import event_abi_to_log_topic, to_checksum_address
+from web3 import Web3
+import time
+
+from scheduler import classify_error, backoff_delay, RATE_LIMITED, SIZE, TIMEOUT
+
+
+@lru_cache(maxsize=None)
+def decode_address(word):
+    # depositors repeat a lot, so each address is checksummed once
+    return to_checksum_address('0x' + word[-40:])
+
+
+def decode_uint(word):
+    return int(word, 16)
+
+
+def decode_bool(word):
+    return int(word, 16) != 0
+
+
+def decode_bytes32(word):
+    return bytes.fromhex(word)
+
+
+class LogScanner(object):
+
+    def __init__(self, contract, event_names, argument_filters=None):
+
+        # event_names: one event, or several events sharing the same inputs (e.g. Deposit, Withdraw, EmergencyWithdraw)
+        # which are then fetched with a single eth_getLogs per chunk
+        event_names = [event_names] if isinstance(event_names, str) else list(event_names)
+
+        self.contract = contract
+        self.event_abis = [contract.events[event_name]()._get_event_abi() for event_name in event_names]
+
+        layouts = set(tuple((arg['name'], arg['type'], arg['indexed']) for arg in event_abi['inputs']) for event_abi in self.event_abis)
+        assert len(layouts) == 1, 'events scanned together must have the same inputs ({})'.format(event_names)
+
+        self.event_names = {Web3.toHex(event_abi_to_log_topic(event_abi)): event_abi['name'] for event_abi in self.event_abis}
+        self.topics = self.encode_topics(self.event_abis, argument_filters or dict())
+
+        # logs are decoded straight from the raw json-rpc response into compact tuples,
+        # e.g. Deposit -> (block_number, log_index, event, user, pid, amount)
+        self.entry_type = namedtuple('{}Log'.format(''.join(event_names)),
+                                     ['block_number', 'log_index', 'event'] + [arg['name'] for arg in self.event_abis[0]['inputs']])
+        self.decoders = self.make_decoders(self.event_abis[0])
+
+    @staticmethod
+    def make_decoders(event_abi):
+
+        # (is indexed, topic or data word position, decoder) per input, only static 32 byte types have a fixed layout
+        decoders = list()
+        n_topics = n_words = 0
+
+        for arg in event_abi['inputs']:
+
+            if arg['type'] == 'address':
+                decode = decode_address
+            elif arg['type'].startswith('uint'):
+                decode = decode_uint
+            elif arg['type'] == 'bool':
+                decode = decode_bool
+            elif arg['type'] == 'bytes32':
+                decode = decode_bytes32
+            else:
+                raise TypeError('unsupported event argument type {} ({})'.format(arg['type'], arg['name']))
+
+            if arg['indexed']:
+                n_topics += 1
+                decoders.append((True, n_topics, decode))
+            else:
+                decoders.append((False, n_words, decode))
+                n_words += 1
+
+        return decoders
+
+    @staticmethod
+    def encode_topic(abi_type, value):
+        return Web3.toHex(encode_single(abi_type, value))
+
+    @classmethod
+    def encode_topics(cls, event_abis, argument_filters):
+
+        # topic0 is the event signature (or any of them), followed by one topic per indexed input (None matches anything)
+        event_topics = [Web3.toHex(event_abi_to_log_topic(event_abi)) for event_abi in event_abis]
+        topics = [event_topics[0] if len(event_topics) == 1 else event_topics]
+
+        for arg in event_abis[0]['inputs']:
+            if not arg['indexed']:
+                continue
+
+            value = argument_filters.get(arg['name'])
+            if value is None:
+                topics.append(None)
+            elif isinstance(value, (list, tuple, set)):
+                topics.append([cls.encode_topic(arg['type'], v) for v in value])
+            else:
+                topics.append(cls.encode_topic(arg['type'], value))
+
+        # trailing wildcards are implicit
+        while topics[-1] is None:
+            topics.pop()
+
+        return topics
+
+    def log_filter(self, from_block, to_block):
+        return {'address': self.contract.address, 'topics': self.topics, 'fromBlock': Web3.toHex(from_block), 'toBlock': Web3.toHex(to_block)}
+
+    def get_logs(self, from_block, to_block):
+
+        # raw eth_getLogs, skipping web3's result formatters
+        response = self.contract.web3.provider.make_request('eth_getLogs', [self.log_filter(from_block, to_block)])
+        if 'error' in response:
+            raise ValueError(response['error'])
+
+        return response['result']
+
+    def decode_log(self, log):
+
+        topics = log['topics']
+        data = log['data']
+        values = [int(log['blockNumber'], 16), int(log['logIndex'], 16), self.event_names[topics[0]]]
+
+        for indexed, position, decode in self.decoders:
+            values.append(decode(topics[position][2:] if indexed else data[2 + 64 * position:66 + 64 * position]))
+
+        return self.entry_type(*values)
+
+    def get_entries(self, from_block, to_block):
+        return [self.decode_log(log) for log in self.get_logs(from_block, to_block)]
+
+
+class ChunkSizeController(object):
+
+    MAX_ENTRIES = 10000
+    GROWTH_DIVISOR = 8
+    PROBE_AFTER = 100
+
+    def __init__(self, max_size):
+
+        self.max_size = max_size
+        self.size = max_size
+        self.failed_size = None
+        self.successes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_size_error(e):
+        # only errors caused by the size of a range shrink the chunks, throttling is handled by backing off
+        return classify_error(e) in (SIZE, TIMEOUT)
+
+    def success(self, size, n_entries):
+
+        with self._lock:
+
+            self.successes += 1
+
+            # grow slowly from the current size, but stay below the last size that failed until enough
+            # consecutive successes suggest the node (or the log density) has changed
+            if self.failed_size is not None and self.successes >= self.PROBE_AFTER:
+                self.failed_size = None
+
+            if size < self.size or n_entries >= self.MAX_ENTRIES // 2:
+                return
+
+            ceiling = self.max_size if self.failed_size is None else min(self.max_size, self.failed_size - 1)
+            self.size = max(self.size, min(ceiling, size + max(1, size // self.GROWTH_DIVISOR)))
+
+    def failure(self, size):
+
+        with self._lock:
+            self.successes = 0
+            self.failed_size = size if self.failed_size is None else min(self.failed_size, size)
+            self.size = min(self.size, max(size // 2, 1))
+
+
+class BlockRangeScanner(object):
+
+    N_WORKERS = 4
+    # tries of a range failing with an error that is neither throttling nor caused by its size
+    MAX_TRIES = 5
+
+    def __init__(self, fetch, n_workers=N_WORKERS, verbose=0):
+
+        # fetch: (from_block, to_block) -> entries, called concurrently from the worker threads
+        self.fetch = fetch
+        self.n_workers = max(n_workers, 1)
+        self.verbose = verbose
+
+    def scan(self, first_block, last_block, controller, on_chunk):
+
+        # walks [first_block, last_block] from the newest block backwards like the sequential loop did, and
+        # calls on_chunk(from_block, to_block, entries) in that same order no matter which worker finishes first
+        cursor = last_block
+        retry = deque()
+        done = dict()
+        release_block = last_block
+        throttled = 0
+        errors = dict()
+
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+
+            futures = dict()
+
+            while True:
+
+                while len(futures) < self.n_workers and (retry or cursor >= first_block):
+
+                    chunk_size = controller.size
+
+                    # failed ranges are newer than the cursor, re-carve them with the current chunk size first
+                    if retry:
+                        from_block, to_block = retry.popleft()
+                        if to_block - from_block > chunk_size:
+                            retry.appendleft((from_block, to_block - chunk_size - 1))
+                            from_block = to_block - chunk_size
+                    else:
+                        from_block, to_block = max(first_block, cursor - chunk_size), cursor
+                        cursor = from_block - 1
+
+                    if self.verbose >= 2:
+                        print('chunk_size={}, from_block={}, to_block={}'.format(chunk_size, from_block, to_block))
+
+                    futures[executor.submit(self.fetch, from_block, to_block)] = (from_block, to_block)
+
+                if not futures:
+                    break
+
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+
+                for future in sorted(finished, key=lambda f: futures[f], reverse=True):
+
+                    from_block, to_block = futures.pop(future)
+
+                    try:
+                        entries = future.result()
+                    except Exception as e:
+
+                        if self.verbose >= 2:
+                            print(e)
+
+                        # a throttling node wants fewer requests, not smaller ones: back off without shrinking the chunks
+                        if controller.is_size_error(e):
+                            controller.failure(to_block - from_block)
+                        elif classify_error(e) == RATE_LIMITED:
+                            throttled += 1
+                            time.sleep(backoff_delay(throttled))
+                        else:
+                            # e.g. a node that is missing the range's headers, the entry fails after MAX_TRIES
+                            errors[to_block] = errors.get(to_block, 0) + 1
+                            if errors[to_block] >= self.MAX_TRIES:
+                                for pending in futures:
+                                    pending.cancel()
+                                raise
+                            time.sleep(backoff_delay(errors[to_block]))
+
+                        retry.appendleft((from_block, to_block))
+                        continue
+
+                    throttled = 0
+                    controller.success(to_block - from_block, len(entries))
+                    done[to_block] = (from_block, entries)
+
+                # keep retried ranges newest first
+                retry = deque(sorted(retry, reverse=True))
+
+                # release every contiguous range below the newest unreleased block
+                while release_block in done:
+                    from_block, entries = done.pop(release_block)
+                    on_chunk(from_block, release_block, entries)
+                    release_block = from_block - 1
@@ -0,0 +1,184 @@
+from requests.exceptions import Timeout
+import threading
+import asyncio
+import random
+import time
+
+
+RATE_LIMITED = 'rate_limited'
+SIZE = 'size'
+TIMEOUT = 'timeout'
+OTHER = 'other'
+
+# checked before the size patterns, e.g. 'too many requests' is throttling while 'too many logs' is a size error
+RATE_LIMIT_ERRORS = ('rate limit', 'rate-limit', 'too many requests', 'request limit', 'requests limit', 'limit exceeded', 'exceeded the limit',
+                     'capacity', 'throttl', 'daily request count')
+SIZE_ERRORS = ('more than', 'too many', 'too large', 'response size', 'block range', 'payload', 'timeout')
+
+
+def http_status(e):
+    # status of an http error from requests or aiohttp, None for any other error
+    return getattr(getattr(e, 'response', None), 'status_code', None) or getattr(e, 'status', None)
+
+
+def classify_error(e):
+
+    # json-rpc errors come from web3 as ValueError({'code': ..., 'message': ...}), http errors from requests or aiohttp
+    if isinstance(e, Timeout):
+        return TIMEOUT
+
+    if http_status(e) == 429:
+        return RATE_LIMITED
+
+    error = e.args[0] if isinstance(e, Exception) and e.args else e
+    code = error.get('code') if isinstance(error, dict) else None
+    message = str(error.get('message', '') if isinstance(error, dict) else error).lower()
+
+    if any(pattern in message for pattern in RATE_LIMIT_ERRORS):
+        return RATE_LIMITED
+    if code == -32603 or any(pattern in message for pattern in SIZE_ERRORS):
+        return SIZE
+    # infura and others answer both 'more than 10000 results' and throttling with -32005
+    if code == -32005:
+        return RATE_LIMITED
+
+    return OTHER
+
+
+def backoff_delay(attempt, base_delay=1, max_delay=60):
+    # exponential backoff with full jitter, attempt counts from 1
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate=None, burst=None):
+
+        # rate: requests per second (None for no limit), burst: requests that may be sent at once
+        self.rate = rate
+        self.burst = max(burst or 1, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+
+        # takes a token and returns how long the caller has to wait before sending, tokens may go negative so
+        # callers queue up in the order they reserved
+        with self._lock:
+
+            now = time.monotonic()
+            wait = max(0, self.paused_until - now)
+
+            if self.rate:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                self.tokens -= 1
+                wait = max(wait, -self.tokens / self.rate)
+
+            return wait
+
+    def try_acquire(self):
+
+        # takes a token if one is available, without queueing
+        with self._lock:
+
+            now = time.monotonic()
+            if self.rate:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+            if now < self.paused_until or (self.rate and self.tokens < 1):
+                return False
+
+            if self.rate:
+                self.tokens -= 1
+            return True
+
+    def pause(self, delay):
+
+        # nothing is sent to a throttling node until the backoff is over
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+
+class RequestScheduler(object):
+
+    MAX_RETRIES = 5
+    BASE_DELAY = 1
+    MAX_DELAY = 60
+
+    def __init__(self, rate=None, burst=None, max_retries=MAX_RETRIES, base_delay=BASE_DELAY, max_delay=MAX_DELAY, verbose=0):
+
+        # one token bucket per node url, throttled requests are retried with backoff up to max_retries times
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.verbose = verbose
+
+        self._lock = threading.Lock()
+        self._buckets = dict()
+
+    def bucket(self, endpoint):
+
+        with self._lock:
+            if endpoint not in self._buckets:
+                self._buckets[endpoint] = TokenBucket(self.rate, self.burst)
+            return self._buckets[endpoint]
+
+    @staticmethod
+    def response_error(response):
+        # json-rpc error of a single (not batched) response
+        return response.get('error') if isinstance(response, dict) else None
+
+    def throttled(self, endpoint, attempt, error):
+
+        # returns the backoff before the next attempt, or None once max_retries is reached
+        if attempt >= self.max_retries:
+            return None
+
+        delay = backoff_delay(attempt + 1, self.base_delay, self.max_delay)
+        self.bucket(endpoint).pause(delay)
+
+        if self.verbose >= 2:
+            print('{} throttled ({}), retrying in {:.1f}s'.format(endpoint, error, delay))
+        return delay
+
+    def call(self, endpoint, send):
+
+        # send() posts one request and returns the decoded response
+        for attempt in range(self.max_retries + 1):
+
+            time.sleep(self.bucket(endpoint).reserve())
+
+            try:
+                response = send()
+            except Exception as e:
+                if classify_error(e) != RATE_LIMITED or self.throttled(endpoint, attempt, e) is None:
+                    raise
+                continue
+
+            error = self.response_error(response)
+            if error is None or classify_error(ValueError(error)) != RATE_LIMITED or self.throttled(endpoint, attempt, error) is None:
+                return response
+
+    async def async_call(self, endpoint, send):
+
+        # same as call for a coroutine function send
+        for attempt in range(self.max_retries + 1):
+
+            await asyncio.sleep(self.bucket(endpoint).reserve())
+
+            try:
+                response = await send()
+            except Exception as e:
+                if classify_error(e) != RATE_LIMITED or self.throttled(endpoint, attempt, e) is None:
+                    raise
+                continue
+
+            error = self.response_error(response)
+            if error is None or classify_error(ValueError(error)) != RATE_LIMITED or self.throttled(endpoint, attempt, error) is None:
+                return response
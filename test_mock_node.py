@@ -0,0 +1,86 @@
+from web3 import Web3
+import unittest
+import json
+import os
+
+from mock_node import SyntheticChain, MockNode, DEPOSIT
+from scanner import LogScanner, BlockRangeScanner, ChunkSizeController
+
+
+CONFIG_FNAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
+
+
+class MockNodeScanTest(unittest.TestCase):
+
+    # every scanning strategy has to find the same Deposit logs of the synthetic chain
+
+    @classmethod
+    def setUpClass(cls):
+
+        with open(CONFIG_FNAME) as f:
+            contract_info = json.load(f)[0]
+
+        cls.pid = contract_info['pid']
+        cls.chain = SyntheticChain(n_users=50, n_logs=2000, n_pools=cls.pid + 2, head_block=200000, start_block=100000,
+                                   master_chef=contract_info['address'], lp_addresses={cls.pid: contract_info['lp']['address']})
+        cls.node = MockNode(cls.chain, max_block_range=20000)
+        cls.node.start()
+
+        cls.w3 = Web3(Web3.HTTPProvider(cls.node.url))
+        cls.contract = cls.w3.eth.contract(address=Web3.toChecksumAddress(contract_info['address']), abi=contract_info['abi'])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.node.stop()
+
+    def expected_deposits(self, from_block, to_block):
+
+        blocks, log_indexes, events, users, amounts = self.chain.logs[self.pid]
+        return [(block, log_index, self.chain.users[user], amount) for block, log_index, event, user, amount in zip(blocks, log_indexes, events, users, amounts)
+                if event == DEPOSIT and from_block <= block <= to_block]
+
+    def test_filter(self):
+
+        # the baseline strategy: eth_newFilter with the address list web3 sends, then eth_getFilterLogs
+        from_block, to_block = 150000, 165000
+        deposit_filter = self.contract.events.Deposit.createFilter(fromBlock=from_block, toBlock=to_block, argument_filters={'pid': self.pid})
+        deposits = [(entry['blockNumber'], entry['logIndex'], entry['args']['user'], entry['args']['amount'])
+                    for entry in deposit_filter.get_all_entries()]
+
+        self.assertTrue(deposits)
+        self.assertEqual(deposits, self.expected_deposits(from_block, to_block))
+
+    def test_log_scanner(self):
+
+        from_block, to_block = 150000, 165000
+        log_scanner = LogScanner(self.contract, 'Deposit', argument_filters={'pid': self.pid})
+        deposits = [(entry.block_number, entry.log_index, entry.user, entry.amount) for entry in log_scanner.get_entries(from_block, to_block)]
+
+        self.assertTrue(deposits)
+        self.assertEqual(deposits, self.expected_deposits(from_block, to_block))
+
+    def test_block_range_scanner(self):
+
+        # ranges above the node's max_block_range fail and are split, chunks still come out newest first
+        log_scanner = LogScanner(self.contract, 'Deposit', argument_filters={'pid': self.pid})
+        chunks = list()
+        BlockRangeScanner(log_scanner.get_entries).scan(self.chain.start_block, self.chain.head_block, ChunkSizeController(50000),
+                                                        lambda from_block, to_block, entries: chunks.append((from_block, to_block, entries)))
+
+        self.assertEqual([to_block for from_block, to_block, entries in chunks], sorted((to_block for from_block, to_block, entries in chunks), reverse=True))
+        deposits = sorted((entry.block_number, entry.log_index, entry.user, entry.amount) for from_block, to_block, entries in chunks for entry in entries)
+        self.assertEqual(deposits, self.expected_deposits(self.chain.start_block, self.chain.head_block))
+
+    def test_filter_ids(self):
+
+        log_filter = {'address': [self.contract.address], 'fromBlock': hex(self.chain.start_block), 'toBlock': hex(self.chain.head_block)}
+        first = self.w3.manager.request_blocking('eth_newFilter', [log_filter])
+        self.assertTrue(self.w3.manager.request_blocking('eth_uninstallFilter', [first]))
+        second = self.w3.manager.request_blocking('eth_newFilter', [log_filter])
+        third = self.w3.manager.request_blocking('eth_newFilter', [log_filter])
+
+        self.assertEqual(len({first, second, third}), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+from web3 import Web3
+import tempfile
+import unittest
+import os
+
+from cache import CodeStore
+from mock_node import SyntheticChain, MockNode
+from rpc import ClientRegistry, BatchCaller
+from vaults import VaultClassifier, EIP1967_IMPLEMENTATION_SLOT, EIP1967_BEACON_SLOT
+
+
+def eip1967_slot(name):
+    # keccak256(name) - 1, as defined by EIP-1967
+    return '0x{:064x}'.format(int.from_bytes(Web3.keccak(text=name), 'big') - 1)
+
+
+class EIP1967SlotTest(unittest.TestCase):
+
+    def test_slots(self):
+        self.assertEqual(EIP1967_IMPLEMENTATION_SLOT, eip1967_slot('eip1967.proxy.implementation'))
+        self.assertEqual(EIP1967_BEACON_SLOT, eip1967_slot('eip1967.proxy.beacon'))
+
+
+class VaultClassifierTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        cls.chain = SyntheticChain(n_users=200, n_logs=100, contract_ratio=0.1, proxy_ratio=0.5)
+        cls.node = MockNode(cls.chain)
+        cls.node.start()
+        cls.clients = ClientRegistry({'eth': cls.node.url})
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.clients.close()
+        cls.node.stop()
+        cls.tmp_dir.cleanup()
+
+    def test_classify(self):
+
+        # proxies are told apart by the implementation read from their EIP-1967 slot, not by their shared code
+        batch_caller = BatchCaller(self.clients.w3('eth'))
+        code_store = CodeStore(os.path.join(self.tmp_dir.name, 'code.sqlite'))
+        contracts = self.chain.users[:self.chain.n_contracts]
+
+        codes = {address: (Web3.keccak(hexstr=code).hex(), len(code) // 2 - 1, None)
+                 for address, code in zip(contracts, batch_caller.request([('eth_getCode', [address, 'latest']) for address in contracts]))}
+
+        for run in range(2):
+            # the second run takes the classifications of the clusters from the code store
+            classes = VaultClassifier(batch_caller, batch_caller, code_store, 'eth').classify(codes)
+
+            for address in contracts:
+                implementation = self.chain.implementation(address)
+                if implementation is None:
+                    self.assertEqual(classes[address], ('', 'contract'))
+                elif implementation == self.chain.implementations[0]:
+                    self.assertEqual(classes[address], (VaultClassifier.EIP1967, 'vault'))
+                else:
+                    self.assertEqual(classes[address], (VaultClassifier.EIP1967, 'contract'))
+
+        code_store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+from web3 import Web3
+
+
+# EIP-1967 storage slots of the implementation and beacon addresses
+EIP1967_IMPLEMENTATION_SLOT = '0x360894a13ba1a3210667c828492db98dca3e2076cc3735a920a3ca505d382bbc'
+EIP1967_BEACON_SLOT = '0xa3f0ad74e5423aebfd80d3ef4346578335a9a72aeaee59ff6cb3582b35133d50'
+
+# EIP-1167 minimal proxy runtime code around the 20 byte implementation address
+EIP1167_PREFIX = '0x363d3d373d3d3d363d73'
+EIP1167_SUFFIX = '5af43d82803e903d91602b57fd5bf3'
+
+VAULT_PROBES = ['want', 'strategy', 'controller', 'vault', 'pricePerShare', 'getPricePerFullShare']
+
+VAULT_PROBE_ABI = [{'inputs': [], 'name': name, 'outputs': [{'internalType': 'address', 'name': '', 'type': 'address'}],
+                    'stateMutability': 'view', 'type': 'function'} for name in ['want', 'strategy', 'controller', 'vault']] + \
+                  [{'inputs': [], 'name': name, 'outputs': [{'internalType': 'uint256', 'name': '', 'type': 'uint256'}],
+                    'stateMutability': 'view', 'type': 'function'} for name in ['pricePerShare', 'getPricePerFullShare']]
+
+
+def minimal_proxy_target(code):
+
+    # implementation address of an EIP-1167 minimal proxy, None for any other code
+    code = code.lower()
+    if len(code) != len(EIP1167_PREFIX) + 40 + len(EIP1167_SUFFIX) or not code.startswith(EIP1167_PREFIX) or not code.endswith(EIP1167_SUFFIX):
+        return None
+
+    return Web3.toChecksumAddress('0x' + code[len(EIP1167_PREFIX):len(EIP1167_PREFIX) + 40])
+
+
+def slot_address(word):
+    address = '0x' + word[-40:]
+    return None if int(address, 16) == 0 else Web3.toChecksumAddress(address)
+
+
+class VaultClassifier(object):
+
+    EIP1967 = 'eip1967'
+    EIP1167 = 'eip1167'
+
+    def __init__(self, batch_caller, state_reader, code_store, blockchain, block_identifier='latest'):
+
+        # batch_caller reads the proxy slots, state_reader (a BatchCaller or Multicall) sends the probes
+        self.batch_caller = batch_caller
+        self.state_reader = state_reader
+        self.code_store = code_store
+        self.blockchain = blockchain
+        self.block_identifier = block_identifier
+
+    @staticmethod
+    def contract_type(answers):
+
+        # answers: probe name -> whether the contract answered it
+        if answers['pricePerShare'] or answers['getPricePerFullShare'] or answers['strategy']:
+            return 'vault'
+        if answers['want'] and (answers['controller'] or answers['vault']):
+            return 'strategy'
+        return 'contract'
+
+    def get_proxy_slots(self, addresses):
+
+        # {address: (implementation, beacon)} from the EIP-1967 slots, in one json-rpc batch
+        block_param = self.batch_caller.block_param(self.block_identifier)
+        results = self.batch_caller.request([('eth_getStorageAt', [address, slot, block_param])
+                                             for address in addresses for slot in (EIP1967_IMPLEMENTATION_SLOT, EIP1967_BEACON_SLOT)])
+
+        return {address: (slot_address(results[2 * i]), slot_address(results[2 * i + 1])) for i, address in enumerate(addresses)}
+
+    def probe(self, addresses):
+
+        # {address: contract type}, every probe of every address in one batched read that tolerates reverts
+        contracts = [self.batch_caller.w3.eth.contract(address=Web3.toChecksumAddress(address), abi=VAULT_PROBE_ABI) for address in addresses]
+        results = self.state_reader.call_functions([contract.functions[name]() for contract in contracts for name in VAULT_PROBES],
+                                                   self.block_identifier, allow_failure=True)
+
+        n_probes = len(VAULT_PROBES)
+        return {address: self.contract_type({name: result is not None for name, result in zip(VAULT_PROBES, results[n_probes * i:n_probes * (i + 1)])})
+                for i, address in enumerate(addresses)}
+
+    def classify(self, codes):
+
+        # codes: {address: (code_hash, code_size, minimal proxy target)} of contracts, returns {address: (proxy, contract type)}.
+        # contracts are clustered by code hash, which already includes the implementation of minimal proxies, and only
+        # one contract per cluster is probed. EIP-1967 proxies share their code across implementations, so they are
+        # clustered by implementation (or beacon) read from their storage slots on every run
+        known = self.code_store.get_classifications(self.blockchain, set(code_hash for code_hash, code_size, target in codes.values()))
+
+        classes = dict()
+        clusters = dict()
+        unresolved = set()
+        for address, (code_hash, code_size, target) in codes.items():
+            if code_hash in known and known[code_hash][0] != self.EIP1967:
+                classes[address] = known[code_hash]
+            elif code_hash in known:
+                unresolved.add(address)
+            else:
+                clusters[address] = (code_hash, self.EIP1167 if target else '')
+
+        # unknown code hashes may be EIP-1967 proxies as well
+        proxy_slots = self.get_proxy_slots(list(unresolved) + list(clusters)) if unresolved or clusters else dict()
+        new_proxies = dict()
+
+        for address, (implementation, beacon) in proxy_slots.items():
+
+            code_hash = codes[address][0]
+            if implementation or beacon:
+                clusters[address] = ('{}:{}'.format(code_hash, implementation or 'beacon:{}'.format(beacon)), self.EIP1967)
+                new_proxies[code_hash] = (self.EIP1967, None)
+            elif address in unresolved:
+                # same code as a proxy seen before but without an implementation, e.g. not initialized yet
+                clusters[address] = ('{}:'.format(code_hash), '')
+
+        cluster_keys = set(key for key, proxy in clusters.values())
+        known = self.code_store.get_classifications(self.blockchain, cluster_keys)
+
+        representatives = dict()
+        for address, (key, proxy) in clusters.items():
+            if key not in known:
+                representatives.setdefault(key, (address, proxy))
+
+        contract_types = self.probe([address for address, proxy in representatives.values()]) if representatives else dict()
+        new_classes = {key: (proxy, contract_types[address]) for key, (address, proxy) in representatives.items()}
+        known.update(new_classes)
+
+        if new_classes or new_proxies:
+            self.code_store.add_classifications(self.blockchain, dict(new_classes, **new_proxies))
+
+        for address, (key, proxy) in clusters.items():
+            classes[address] = known[key]
+
+        return classes